@@ -0,0 +1,128 @@
+import os
+import numpy as np
+from config import (mass_grid, theta_grid, base_output_dir, adaptive_thresholds,
+                    adaptive_min_dlog_mass, adaptive_min_dlog_theta, adaptive_max_rounds)
+from utils import point_tag, read_results
+
+def _node_value(result, key):
+    """Numeric value of a result field, or None (missing, failed or SKIPPED)."""
+    if result is None:
+        return None
+    value = result.get(key)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+def cell_crosses(values, thresholds):
+    """
+    True if the corner values of a cell straddle any threshold for any quantity.
+    values maps quantity -> list of corner values (None entries are ignored).
+    """
+    for key, levels in thresholds.items():
+        known = [val for val in values.get(key, []) if val is not None]
+        if len(known) < 2:
+            continue
+        for level in levels:
+            above = [val > level for val in known]
+            if any(above) and not all(above):
+                return True
+    return False
+
+def split_cell(cell, split_mass=True, split_theta=True):
+    """Splits a (log m0, log m1, log t0, log t1) cell in half along the requested axes."""
+    x0, x1, y0, y1 = cell
+    xs = [(x0, 0.5 * (x0 + x1)), (0.5 * (x0 + x1), x1)] if split_mass else [(x0, x1)]
+    ys = [(y0, 0.5 * (y0 + y1)), (0.5 * (y0 + y1), y1)] if split_theta else [(y0, y1)]
+    return [(xa, xb, ya, yb) for ya, yb in ys for xa, xb in xs]
+
+def cell_corners(cell):
+    x0, x1, y0, y1 = cell
+    return [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+
+def initial_cells(masses=None, thetas=None):
+    """
+    Cells between consecutive values of the coarse mass and mixing grids (log10 space).
+    Returns (nodes, cells, coarse) where coarse maps each node to its configured
+    (mass_keV, theta), so coarse points keep their exact values and folder names.
+    """
+    masses = np.unique(masses if masses is not None else mass_grid)
+    thetas = np.unique(thetas if thetas is not None else theta_grid)
+    log_m, log_t = np.log10(masses), np.log10(thetas)
+    nodes = [(x, y) for x in log_m for y in log_t]
+    cells = [(log_m[i], log_m[i + 1], log_t[j], log_t[j + 1])
+             for i in range(len(log_m) - 1) for j in range(len(log_t) - 1)]
+    coarse = {(x, y): (float(m), float(t)) for x, m in zip(log_m, masses) for y, t in zip(log_t, thetas)}
+    return nodes, cells, coarse
+
+def node_point(node, coarse):
+    """(mass_keV, theta) of a node: the configured values for coarse nodes, else rounded to 6 significant digits."""
+    if node in coarse:
+        return coarse[node]
+    return float(f"{10**node[0]:.6g}"), float(f"{10**node[1]:.6g}")
+
+def run_adaptive(run_points, results_dir=base_output_dir, thresholds=None, masses=None, thetas=None,
+                 min_dlog_mass=adaptive_min_dlog_mass, min_dlog_theta=adaptive_min_dlog_theta,
+                 max_rounds=adaptive_max_rounds):
+    """
+    Adaptive mass-mixing scan. Runs the coarse grid, then repeatedly splits every cell
+    whose corner results (read from each point's results.json) cross one of the
+    thresholds, until cells reach the minimum size or max_rounds is hit.
+    run_points(list of (mass_keV, theta)) must run the pipeline for the given points.
+    Returns the list of all (mass_keV, theta) points that were scheduled.
+    """
+    thresholds = adaptive_thresholds if thresholds is None else thresholds
+    nodes, cells, coarse = initial_cells(masses, thetas)
+    node_tags = {}
+    pending = list(nodes)
+    scheduled = []
+
+    for round_no in range(max_rounds + 1):
+        new_points = []
+        for node in pending:
+            if node in node_tags:
+                continue
+            mass, theta = node_point(node, coarse)
+            node_tags[node] = point_tag(mass, theta)
+            new_points.append((mass, theta))
+        if new_points:
+            print(f"[adaptive] Round {round_no}: running {len(new_points)} points ({len(cells)} active cells)")
+            run_points(new_points)
+            scheduled.extend(new_points)
+
+        results = {tag: read_results(os.path.join(results_dir, tag)) for tag in set(node_tags.values())}
+
+        if round_no == max_rounds:
+            break
+
+        next_cells, pending = [], []
+        claimed = {tag: node for node, tag in node_tags.items()}
+        unresolved = 0
+        for cell in cells:
+            corners = cell_corners(cell)
+            values = {key: [_node_value(results.get(node_tags[c]), key) for c in corners] for key in thresholds}
+            if not cell_crosses(values, thresholds):
+                continue
+            split_mass = cell[1] - cell[0] > min_dlog_mass
+            split_theta = cell[3] - cell[2] > min_dlog_theta
+            if not (split_mass or split_theta):
+                continue
+            children = split_cell(cell, split_mass, split_theta)
+            new_nodes = {c for child in children for c in cell_corners(child)} - set(node_tags)
+            new_tags = {node: point_tag(*node_point(node, coarse)) for node in new_nodes}
+            if (len(set(new_tags.values())) < len(new_tags)
+                    or any(claimed.get(tag, node) != node for node, tag in new_tags.items())):
+                # Output folder names cannot resolve this cell any further
+                unresolved += 1
+                continue
+            claimed.update({tag: node for node, tag in new_tags.items()})
+            next_cells.extend(children)
+            pending.extend(new_nodes)
+
+        if unresolved:
+            print(f"[adaptive] {unresolved} crossing cells left unrefined: point tags cannot resolve them")
+        if not next_cells:
+            print(f"[adaptive] Converged after {round_no} refinement rounds")
+            break
+        cells = next_cells
+
+    return scheduled
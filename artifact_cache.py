@@ -0,0 +1,83 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from config import artifact_cache_dir
+from checkpoint import commit_file
+
+# Bump when a change to the pipeline code changes what a stage produces from the same inputs
+CODE_VERSION = "1"
+
+# File digests memoized per process, keyed by (path, mtime, size)
+_digests = {}
+
+def file_digest(path):
+    """SHA-256 of a file's bytes (memoized while the file is unchanged)."""
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    memo_key = (abs_path, stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _digests:
+        h = hashlib.sha256()
+        with open(abs_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[memo_key] = h.hexdigest()
+    return _digests[memo_key]
+
+def input_key(stage, *parts):
+    """Content address of a stage run: hash of the stage name, CODE_VERSION and every input part."""
+    h = hashlib.sha256()
+    for part in (stage, CODE_VERSION) + parts:
+        data = part if isinstance(part, bytes) else str(part).encode()
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def _entry_dir(stage, key, cache_dir):
+    return os.path.join(cache_dir, stage, key[:2], key)
+
+def fetch(stage, key, dest_dir, cache_dir=artifact_cache_dir):
+    """
+    Copies a cached stage's artifacts into dest_dir.
+    Returns the list of file names restored, or None on a cache miss (or with caching disabled).
+    """
+    if not cache_dir:
+        return None
+    entry = _entry_dir(stage, key, cache_dir)
+    if not os.path.isdir(entry):
+        return None
+    os.makedirs(dest_dir, exist_ok=True)
+    names = sorted(os.listdir(entry))
+    for name in names:
+        commit_file(os.path.join(entry, name), os.path.join(dest_dir, name))
+    return names
+
+def store(stage, key, files, cache_dir=artifact_cache_dir):
+    """
+    Adds a stage's artifacts (paths, or {name: bytes}) to the cache under its input key.
+    The entry is assembled in a temporary directory and renamed into place, so concurrent
+    writers of the same key are harmless and readers never see a partial entry.
+    """
+    if not cache_dir:
+        return
+    entry = _entry_dir(stage, key, cache_dir)
+    if os.path.isdir(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+    try:
+        if isinstance(files, dict):
+            for name, data in files.items():
+                with open(os.path.join(tmp_dir, name), "wb") as f:
+                    f.write(data)
+        else:
+            for path in files:
+                shutil.copyfile(path, os.path.join(tmp_dir, os.path.basename(path)))
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # Another worker stored the same key first
+        if not os.path.isdir(entry):
+            raise
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,148 @@
+"""
+Throughput benchmark of the Python orchestration layer with stub sterile-dm and CLASS
+executables (benchmark/stubs). Runs main.run_all over synthetic grids for every
+combination of grid size and worker count, each in a fresh directory, and reports
+points/s, per-stage wall time and its overhead over the stubs' configured cost,
+speed-up against the first worker count, total CPU time and the peak RSS of any process.
+
+    python benchmark/run_benchmark.py --points 10,100,1000 --workers 1,2,4 --class-cpu 0.2
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+STUB_COST_STAGES = {"sterile_dm": "sterile", "class": "class"}
+
+def synthetic_grid(n_points):
+    """
+    Near-square mass x theta grid with at least n_points points (masses 3-60 keV). The grid
+    is a full rectangle, so it can hold a few more points than requested (e.g. 12 for 10).
+    """
+    n_mass = int(np.ceil(np.sqrt(n_points)))
+    n_theta = int(np.ceil(n_points / n_mass))
+    masses = np.round(np.logspace(np.log10(3.0), np.log10(60.0), n_mass), 6)
+    thetas = np.round(np.logspace(-16, -13, n_theta), 22)
+    return [float(m) for m in masses], [float(t) for t in thetas]
+
+def run_case(n_points, workers, costs, plots, keep, root):
+    """Runs one campaign in a fresh directory and returns its measurements."""
+    run_dir = tempfile.mkdtemp(prefix=f"bench_{n_points}_{workers}_", dir=root)
+    masses, thetas = synthetic_grid(n_points)
+    overrides = {
+        "mass_grid": masses, "theta_grid": thetas,
+        "sterile_dm_path": os.path.join(BENCH_DIR, "stubs", "sterile-dm"),
+        "class_path": os.path.join(BENCH_DIR, "stubs", "class"),
+        "base_output_dir": "outputs", "lcdm_reference_path": "auto",
+        "max_concurrency": workers, "artifact_cache_dir": None,
+        "save_plots": plots, "adaptive_grid": False, "emulator_screening": None,
+    }
+    env = dict(os.environ)
+    env["GZA_CONFIG_OVERRIDES"] = json.dumps(overrides)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in [REPO_DIR, env.get("PYTHONPATH")] if p)
+    env.update({f"BENCH_{name.upper()}": str(value) for name, value in costs.items()})
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, "run.log"), "w") as log:
+        proc = subprocess.Popen([sys.executable, "-c", "import main; main.run_all()"],
+                                cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+
+    n_run = len(masses) * len(thetas)
+    exit_status = os.waitstatus_to_exitcode(status)
+    case = {"requested_points": n_points, "points": n_run, "workers": workers, "exit_status": exit_status,
+            "wall_s": wall, "points_per_s": n_run / wall, "run_dir": run_dir}
+    if exit_status != 0 or not os.path.exists(os.path.join(run_dir, "timing_summary.json")):
+        # Keep the directory so run.log can be read
+        case["error"] = f"pipeline exited with status {exit_status}, see {os.path.join(run_dir, 'run.log')}"
+        return case
+
+    with open(os.path.join(run_dir, "all_results.json")) as f:
+        results = json.load(f)
+    with open(os.path.join(run_dir, "timing_summary.json")) as f:
+        timing = json.load(f)
+
+    # Pool workers and the stubs are not children main.py waits for, so CPU and memory
+    # come from the per-stage records (the wait4 usage covers the main process only).
+    top_level = {stage: stats for stage, stats in timing.items() if stage not in ("plot",)}
+    stage_cpu = sum(stats["cpu_s"]["total"] + stats["child_cpu_s"]["total"] for stats in top_level.values())
+    peak_rss_kb = max([usage.ru_maxrss] + [stats["child_peak_rss_kb"]["max"] for stats in timing.values()])
+    stages = {}
+    for stage, stats in timing.items():
+        stages[stage] = {"p50_s": stats["wall_s"]["p50"], "p90_s": stats["wall_s"]["p90"]}
+        if stage in STUB_COST_STAGES:
+            prefix = STUB_COST_STAGES[stage]
+            cost = costs[f"{prefix}_sleep"] + costs[f"{prefix}_cpu"]
+            stages[stage]["overhead_p50_s"] = stats["wall_s"]["p50"] - cost
+
+    case.update({"finished": len(results), "cpu_s": usage.ru_utime + usage.ru_stime + stage_cpu,
+                 "peak_rss_mb": peak_rss_kb / 1024, "stages": stages})
+    if not keep:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        del case["run_dir"]
+    return case
+
+def print_report(cases):
+    base = {}
+    print(f"{'points':>7} {'workers':>7} {'wall s':>8} {'pts/s':>8} {'speedup':>7} {'cpu s':>8} "
+          f"{'RSS MB':>7}  stage p50 wall (overhead) s")
+    for case in cases:
+        if "error" in case:
+            print(f"{case['points']:>7} {case['workers']:>7}  failed: {case['error']}")
+            continue
+        base.setdefault(case["points"], case["wall_s"])
+        stages = "  ".join(
+            f"{stage}={s['p50_s']:.3f}" + (f" ({s['overhead_p50_s']:+.3f})" if "overhead_p50_s" in s else "")
+            for stage, s in sorted(case["stages"].items()))
+        print(f"{case['points']:>7} {case['workers']:>7} {case['wall_s']:>8.2f} {case['points_per_s']:>8.2f} "
+              f"{base[case['points']] / case['wall_s']:>7.2f} {case['cpu_s']:>8.2f} "
+              f"{case['peak_rss_mb']:>7.1f}  {stages}")
+        if case["finished"] != case["points"] or case["exit_status"] != 0:
+            print(f"        warning: {case['finished']}/{case['points']} points finished, "
+                  f"exit status {case['exit_status']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline with stub executables.")
+    parser.add_argument("--points", default="10,100", help="comma-separated grid sizes (10-10000)")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated max_concurrency values")
+    parser.add_argument("--sterile-sleep", type=float, default=0.0, help="stub sterile-nu sleep per run (s)")
+    parser.add_argument("--sterile-cpu", type=float, default=0.0, help="stub sterile-nu busy CPU per run (s)")
+    parser.add_argument("--class-sleep", type=float, default=0.0, help="stub CLASS sleep per run (s)")
+    parser.add_argument("--class-cpu", type=float, default=0.0, help="stub CLASS busy CPU per run (s)")
+    parser.add_argument("--psd-rows", type=int, default=1000, help="rows of the stub Snapshot100.dat")
+    parser.add_argument("--state-rows", type=int, default=200, help="rows of the stub state.dat")
+    parser.add_argument("--pk-per-decade", type=int, default=40, help="k samples per decade of the stub pk.dat")
+    parser.add_argument("--plots", action="store_true", help="save plot data and render plots as in production")
+    parser.add_argument("--keep", action="store_true", help="keep the run directories")
+    parser.add_argument("--workdir", default=None, help="where run directories are created (default: system temp)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    costs = {"sterile_sleep": args.sterile_sleep, "sterile_cpu": args.sterile_cpu,
+             "class_sleep": args.class_sleep, "class_cpu": args.class_cpu,
+             "psd_rows": args.psd_rows, "state_rows": args.state_rows, "pk_per_decade": args.pk_per_decade}
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    cases = []
+    for n_points in (int(n) for n in args.points.split(",")):
+        for workers in (int(w) for w in args.workers.split(",")):
+            masses, thetas = synthetic_grid(n_points)
+            print(f"Running {len(masses) * len(thetas)} points (requested {n_points}) with {workers} workers...")
+            cases.append(run_case(n_points, workers, costs, args.plots, args.keep, args.workdir))
+
+    print_report(cases)
+    with open(args.output, "w") as f:
+        json.dump({"costs": costs, "cases": cases}, f, indent=2)
+    print(f"Measurements written to {args.output}")
+
+if __name__ == "__main__":
+    main()
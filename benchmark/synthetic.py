@@ -0,0 +1,46 @@
+import os
+import time
+import numpy as np
+
+# Shared physics and cost model of the stub executables. The numbers are only meant to
+# look like real output (file sizes, shapes, value ranges), not to be accurate.
+
+# Fit model of postprocess.py, used to imprint a known thermal mass on the stub spectra
+a, b, v = 0.0437, -1.188, 1.049
+
+def lcdm_power(k):
+    """Smooth LCDM-like linear P(k) in (Mpc/h)^3 (BBKS-shaped, n_s = 0.965)."""
+    q = k / 0.21
+    transfer = np.log(1 + 2.34*q) / (2.34*q) * (1 + 3.89*q + (16.1*q)**2 + (5.46*q)**3 + (6.71*q)**4)**-0.25
+    return 2.1e7 * k**0.965 * transfer**2
+
+def thermal_mass(mass_keV):
+    """Synthetic thermal-mass relation t(m) in keV."""
+    return 0.45 * mass_keV**0.8
+
+def relic_density(mass_keV, theta):
+    """Synthetic final Omega h^2; exceeds 0.12 for heavy, strongly mixed points."""
+    return 0.12 * (mass_keV / 20.0)**1.8 * (theta / 1e-14)
+
+def env_float(name, default=0.0):
+    return float(os.environ.get(name, default))
+
+def spend(seconds_sleep, seconds_cpu):
+    """Simulates a code's cost: sleeps, then keeps one core busy."""
+    if seconds_sleep > 0:
+        time.sleep(seconds_sleep)
+    end = time.process_time() + seconds_cpu
+    x = 0.0
+    while time.process_time() < end:
+        x += np.sum(np.sqrt(np.arange(1000.0)))
+    return x
+
+def read_params(path, separator="="):
+    """Reads key = value lines of a params.ini/CLASS .ini file."""
+    params = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.partition(separator)
+            if sep and not line.lstrip().startswith(("#", "!")):
+                params[key.strip()] = value.strip()
+    return params
@@ -0,0 +1,121 @@
+import os
+import json
+import errno
+import socket
+import shutil
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+
+# Per-point stage state machine, kept in <point>/manifest.json:
+#   {"stages": {"sterile": {"status": ..., "input_key": ..., "attempts": ..., "error_class": ..., ...}}}
+# status is "done" (outputs committed), "overproduced" (sterile only: the point ends there)
+# or "failed". A stage's outputs are written to temporary names and renamed into place
+# before the manifest marks it done, so a crash never leaves outputs that look complete.
+MANIFEST = "manifest.json"
+
+# Errors that may pass on a rerun of the same inputs; everything else is deterministic
+TRANSIENT_ERRORS = (subprocess.TimeoutExpired, MemoryError, ConnectionError, TimeoutError, InterruptedError)
+TRANSIENT_ERRNOS = {errno.ENOSPC, errno.EIO, errno.EAGAIN, errno.ENOMEM, errno.ESTALE, errno.EDQUOT, errno.EMFILE}
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yields a temporary path next to `path` and renames it into place if the block succeeds.
+    The name is unique per host and process, so writers on other nodes of a shared
+    filesystem never share it.
+    """
+    tmp_name = f".{os.path.basename(path)}.{socket.gethostname()}-{os.getpid()}.tmp"
+    tmp_path = os.path.join(os.path.dirname(path), tmp_name)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def commit_file(src, dst, move=False):
+    """Copies (or moves) src to dst so that dst is either absent or complete."""
+    with atomic_output(dst) as tmp_path:
+        (shutil.move if move else shutil.copyfile)(src, tmp_path)
+
+def write_json(path, data, **kwargs):
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, **kwargs)
+
+def read_manifest(point_dir):
+    try:
+        with open(os.path.join(point_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"stages": {}}
+
+def stage_entry(point_dir, stage):
+    """The manifest entry of one stage of a point, or None."""
+    return read_manifest(point_dir)["stages"].get(stage)
+
+def mark_stage(point_dir, stage, status, input_key=None, **fields):
+    """Records a stage's new status (and input key) in the point's manifest."""
+    manifest = read_manifest(point_dir)
+    manifest["stages"][stage] = {"status": status, "input_key": input_key,
+                                 "updated": datetime.now().isoformat(timespec="seconds"), **fields}
+    os.makedirs(point_dir, exist_ok=True)
+    write_json(os.path.join(point_dir, MANIFEST), manifest, indent=4)
+
+def clear_stage(point_dir, stage):
+    """Forgets a stage's status, e.g. when its outputs were overwritten."""
+    manifest = read_manifest(point_dir)
+    if manifest["stages"].pop(stage, None) is not None:
+        write_json(os.path.join(point_dir, MANIFEST), manifest, indent=4)
+
+def classify_error(exc):
+    """"transient" for failures that may pass on a rerun (timeouts, signals, resource limits), else "deterministic"."""
+    if isinstance(exc, subprocess.CalledProcessError):
+        # Killed by a signal (e.g. the OOM killer) vs. an error exit of the program itself
+        return "transient" if exc.returncode < 0 else "deterministic"
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return "transient"
+    if isinstance(exc, OSError) and exc.errno in TRANSIENT_ERRNOS:
+        return "transient"
+    return "deterministic"
+
+def known_failure(point_dir, stage, input_key):
+    """The manifest entry if this stage already failed deterministically on the same inputs, else None."""
+    entry = stage_entry(point_dir, stage)
+    if (entry and entry["status"] == "failed" and entry.get("error_class") == "deterministic"
+            and entry.get("input_key") == input_key):
+        return entry
+    return None
+
+def transient_failure(point_dir, stages, since):
+    """The manifest entry of the first of these stages that failed transiently at or after `since` (ISO time), or None."""
+    manifest = read_manifest(point_dir)["stages"]
+    for stage in stages:
+        entry = manifest.get(stage)
+        if (entry and entry["status"] == "failed" and entry.get("error_class") == "transient"
+                and entry.get("updated", "") >= since):
+            return entry
+    return None
+
+def run_checkpointed(point_dir, stage, input_key, fn, passthrough=()):
+    """
+    Runs fn(), which commits the stage's outputs, and marks the stage done with input_key.
+    A failure is recorded in the manifest with its class (see classify_error) and re-raised;
+    the scheduler reruns transient ones after a backoff (see transient_failure), so no worker
+    waits in between. Exceptions in passthrough (outcomes rather than failures) are re-raised
+    without being recorded. Returns fn's result.
+    """
+    entry = stage_entry(point_dir, stage)
+    attempts = entry.get("attempts", 0) if entry and entry.get("input_key") == input_key else 0
+    attempts += 1
+    try:
+        result = fn()
+    except passthrough:
+        raise
+    except Exception as e:
+        mark_stage(point_dir, stage, "failed", input_key, attempts=attempts, error_class=classify_error(e),
+                   error=f"{type(e).__name__}: {e}")
+        raise
+    mark_stage(point_dir, stage, "done", input_key, attempts=attempts)
+    return result
@@ -1,3 +1,5 @@
+import os
+import json
 import numpy as np 
 
 #can do single points or arrays. Delete sample poin output or change below values to test install
@@ -9,7 +11,63 @@ sterile_dm_path = "/Users/temp/physcode/sterile-dm" #reference README for instal
 class_path = "/Users/temp/physcode/class_public" #reference README for install
 
 base_output_dir = "outputs" #change for separate data storage
-lcdm_reference_path = "LCDM.dat" #Generate from CLASS using your preferred cosmology (pk.dat)
-P_k_max_h_Mpc = 100.0 #increase for larger particle masses
+lcdm_reference_path = "auto" #"auto" generates the LCDM reference with CLASS from the same parameters (sterile species replaced by CDM), evaluated at the sterile runs' k nodes with classy; or a pk.dat from your preferred cosmology
+P_k_max_h_Mpc = 100.0 #increase for larger particle masses (unused with auto_k_range)
+auto_k_range = False #pick P_k_max_h/Mpc and k sampling per point from the expected half-mode scale, extended after the fit if needed
+k_max_ladder = [10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0] #allowed P_k_max_h/Mpc values with auto_k_range (quantized so cached CLASS runs are shared)
+k_resolve_T = 0.1 #with auto_k_range, k must reach the scale where T(k) drops to this value
+k_suppression_samples = 20 #with auto_k_range, CLASS k nodes between T = 0.9 and k_resolve_T
 save_plots = True
+plot_niceness = 10 #niceness of the background batch plot renderer started after the grid
 summary_page = True
+sterile_dm_isolated = True #run each sterile-dm job in its own work dir (required for parallel runs)
+class_backend = "executable" #"executable" runs ./class; "classy" runs CLASS in-process via its Python wrapper (falls back to the executable if classy is not installed)
+overproduction_threshold = 0.125 #Omega h^2 above which a point counts as overproduced
+
+# Adaptive grid: start from mass_grid x theta_grid and only refine cells where a result crosses a threshold
+adaptive_grid = False
+adaptive_thresholds = {"dm_density": [overproduction_threshold], "thermal_mass": []} #refine where these results cross any listed value
+adaptive_min_dlog_mass = 0.01 #smallest cell size in log10(mass)
+adaptive_min_dlog_theta = 0.05 #smallest cell size in log10(theta)
+adaptive_max_rounds = 8
+
+# Emulator pre-screening trained on all_results.json: None, "deprioritize" or "skip" points confidently predicted overproduced
+emulator_screening = None
+emulator_sigma = 3.0 #confidence (in predictive sigmas) needed to deprioritize/skip a point
+
+# Scheduling: sterile-dm and CLASS run as separate pipelined stages, longest predicted runtime first
+max_concurrency = None #total concurrent stage processes (None = the CPU limit from CPU affinity and cgroup quota)
+stage_concurrency = {"sterile": None, "class": None} #per-stage caps (None = max_concurrency)
+# Admission control: a stage process starts only when its footprint (peak RSS and cores, learned from earlier runs) fits
+omp_threads = {"sterile": 1, "class": 1} #OMP_NUM_THREADS of each stage's processes (CLASS built with OpenMP uses this many threads)
+default_stage_memory_mb = {"sterile": 500, "class": 2000} #peak RSS assumed for a stage until runs have been recorded
+memory_headroom = 0.9 #fraction of the memory available at start (MemAvailable / cgroup limit) that stage processes may use
+footprint_margin = 1.2 #learned peak RSS is scaled by this before admitting a run
+
+# CLASS precision profiles: overrides of the CLASS parameters in prepare_class_input.class_parameters (None removes a parameter)
+class_profiles = {
+    "full": {},
+    "screening": {  # z=0 mPk only with coarse ncdm sampling, for a quick thermal-mass estimate
+        "output": "mPk", "lensing": None, "l_max_scalars": None,
+        "ncdm_N_momentum_bins": "50,50", "tol_ncdm": "1e-2", "tol_ncdm_bg": "1e-2",
+        "recombination": "RECFAST",
+    },
+}
+class_profile = "full" #profile of the final CLASS run of every point
+class_screening_profile = None #e.g. "screening": run this profile first and rerun with class_profile only if the coarse t is in class_full_window
+class_full_window = (0.0, float("inf")) #(t_min, t_max) keV of coarse thermal masses that get a full-precision rerun
+
+artifact_cache_dir = "artifact_cache" #content-addressed sterile-dm/CLASS outputs shared across campaigns (None disables)
+stage_max_attempts = 3 #runs of a stage per campaign when it fails transiently (timeout, killed by a signal, I/O or memory error)
+stage_retry_backoff = 10.0 #seconds before the first retry of a transient failure, doubled for each further retry
+queue_heartbeat = 30.0 #seconds between heartbeats of a distributed worker (main.py --worker) on its claimed point
+queue_stale_after = 300.0 #claims without a heartbeat for this long are requeued (crashed worker)
+queue_max_attempts = 3 #a point whose claim went stale this many times is moved to queue/failed
+
+# Scripted runs (e.g. benchmark/run_benchmark.py) can override any setting above with a
+# JSON object in GZA_CONFIG_OVERRIDES; it is read at import, so pool workers see it too.
+_overrides = json.loads(os.environ.get("GZA_CONFIG_OVERRIDES") or "{}")
+_unknown = [name for name in _overrides if name.startswith("_") or name not in globals()]
+if _unknown:
+    raise KeyError(f"Unknown settings in GZA_CONFIG_OVERRIDES: {', '.join(_unknown)}")
+globals().update(_overrides)
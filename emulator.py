@@ -0,0 +1,197 @@
+import os
+import json
+import numpy as np
+from config import overproduction_threshold
+
+# Quantities emulated in log10 space (strictly positive) vs. linear space
+LOG_TARGETS = ("dm_density", "thermal_mass")
+LINEAR_TARGETS = ("lepton_asymmetry",)
+TARGETS = LOG_TARGETS + LINEAR_TARGETS
+
+# Candidate RBF length scales (in standardized log-mass / log-mixing units)
+LENGTH_SCALES = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+MAX_TRAINING_POINTS = 1500  # larger result sets are subsampled (the GP solve is O(n^3))
+SELECTION_POINTS = 200  # subset on which the length scales are chosen
+
+# Emulator cached per process for emulate(), keyed by results file path and mtime
+_cached = {}
+
+
+class _GaussianProcess:
+    """
+    Minimal zero-mean GP with an anisotropic RBF kernel. The length scales are tuned by
+    marginal likelihood on a grid over a random subset of at most SELECTION_POINTS points;
+    the model is then factorized once on at most MAX_TRAINING_POINTS points.
+    """
+
+    def __init__(self, X, y, noise=1e-4, seed=0):
+        rng = np.random.default_rng(seed)
+        if len(X) > MAX_TRAINING_POINTS:
+            keep = rng.choice(len(X), MAX_TRAINING_POINTS, replace=False)
+            X, y = X[keep], y[keep]
+        self.y_mean, self.y_std = y.mean(), y.std() or 1.0
+        y_n = (y - self.y_mean) / self.y_std
+        self.X = X
+        self.noise = noise
+
+        subset = rng.choice(len(X), SELECTION_POINTS, replace=False) if len(X) > SELECTION_POINTS else slice(None)
+        best = None
+        for l0 in LENGTH_SCALES:
+            for l1 in LENGTH_SCALES:
+                scales = np.array([l0, l1])
+                fit = self._factorize(X[subset], y_n[subset], scales)
+                if fit is None:
+                    continue
+                L, alpha = fit
+                log_ml = -0.5 * y_n[subset] @ alpha - np.log(np.diag(L)).sum()
+                if best is None or log_ml > best[0]:
+                    best = (log_ml, scales)
+        fit = self._factorize(X, y_n, best[1]) if best is not None else None
+        if fit is None:
+            raise np.linalg.LinAlgError("Could not factorize the emulator kernel matrix.")
+        self.scales = best[1]
+        self.L, self.alpha = fit
+
+    def _factorize(self, X, y_n, scales):
+        """(Cholesky factor, weights) of the kernel matrix at these scales, or None if it is not positive definite."""
+        K = self._kernel(X, X, scales) + self.noise * np.eye(len(X))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return None
+        return L, np.linalg.solve(L.T, np.linalg.solve(L, y_n))
+
+    @staticmethod
+    def _kernel(A, B, scales):
+        # Squared distances as |a|^2 + |b|^2 - 2 a.b, without an n x m x 2 difference array
+        A, B = A / scales, B / scales
+        d2 = (A**2).sum(axis=1)[:, None] + (B**2).sum(axis=1)[None, :] - 2 * A @ B.T
+        return np.exp(-0.5 * np.maximum(d2, 0.0))
+
+    def predict(self, X_new):
+        K_s = self._kernel(X_new, self.X, self.scales)
+        mean = K_s @ self.alpha
+        v = np.linalg.solve(self.L, K_s.T)
+        var = np.clip(1.0 + self.noise - (v**2).sum(axis=0), 0.0, None)
+        return mean * self.y_std + self.y_mean, np.sqrt(var) * self.y_std
+
+
+class Emulator:
+    """
+    Gaussian-process surrogate for pipeline results over (log10 mass, log10 mixing).
+    Trained on results entries (as in all_results.json); predicts dm_density,
+    lepton_asymmetry and thermal_mass with 1-sigma uncertainties. dm_density and
+    thermal_mass are modelled in log10 space.
+    """
+
+    def __init__(self, entries, min_points=5):
+        self.models = {}
+        self.x_mean = self.x_std = None
+        coords = {}
+        for entry in entries:
+            try:
+                x = (np.log10(float(entry["mass_keV"])), np.log10(float(entry["mixing_angle"])))
+            except (KeyError, TypeError, ValueError):
+                continue
+            for target in TARGETS:
+                value = entry.get(target)
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or not np.isfinite(value):
+                    continue
+                if target in LOG_TARGETS:
+                    if value <= 0:
+                        continue
+                    value = np.log10(value)
+                coords.setdefault(target, {})[x] = value  # last entry per point wins
+
+        all_x = np.array([x for points in coords.values() for x in points]) if coords else np.empty((0, 2))
+        if len(all_x):
+            self.x_mean, self.x_std = all_x.mean(axis=0), all_x.std(axis=0)
+            self.x_std[self.x_std == 0] = 1.0
+        for target, points in coords.items():
+            if len(points) < min_points:
+                continue
+            X = self._standardize(np.array(list(points.keys())))
+            self.models[target] = _GaussianProcess(X, np.array(list(points.values())))
+
+    @classmethod
+    def from_results(cls, results_json="all_results.json", **kwargs):
+        """Trains an emulator on a global results file (see global_summary)."""
+        with open(results_json) as f:
+            return cls(json.load(f), **kwargs)
+
+    def _standardize(self, X):
+        return (X - self.x_mean) / self.x_std
+
+    def predict_log(self, masses, thetas):
+        """
+        Raw GP predictions: {target: (mean, std)} arrays, in log10 units for
+        dm_density and thermal_mass. Targets without enough training data are omitted.
+        """
+        X = np.column_stack([np.log10(np.atleast_1d(masses)), np.log10(np.atleast_1d(thetas))])
+        return {target: model.predict(self._standardize(X)) for target, model in self.models.items()}
+
+    def predict(self, mass, theta):
+        """Returns {target: (value, sigma)} for one point, in natural units."""
+        prediction = {}
+        for target, (mean, std) in self.predict_log(mass, theta).items():
+            mean, std = float(mean[0]), float(std[0])
+            if target in LOG_TARGETS:
+                value = 10**mean
+                prediction[target] = (value, value * np.log(10) * std)
+            else:
+                prediction[target] = (mean, std)
+        return prediction
+
+    def overproduction_confidence(self, masses, thetas):
+        """
+        Signed distance, in predictive sigmas, of log10(dm_density) above the
+        overproduction threshold (positive = overproduced). None without a dm_density model.
+        """
+        if "dm_density" not in self.models:
+            return None
+        mean, std = self.predict_log(masses, thetas)["dm_density"]
+        return (mean - np.log10(overproduction_threshold)) / np.maximum(std, 1e-12)
+
+
+def load_emulator(results_json="all_results.json"):
+    """Returns a process-cached Emulator for results_json, retrained when the file changes."""
+    path = os.path.abspath(results_json)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _cached.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Emulator.from_results(path))
+        _cached[path] = cached
+    return cached[1]
+
+def emulate(mass, theta, results_json="all_results.json"):
+    """Instant lookup: predicted {target: (value, sigma)} for a (mass_keV, theta) point."""
+    return load_emulator(results_json).predict(mass, theta)
+
+def screen_points(points, results_json="all_results.json", mode="deprioritize", n_sigma=3.0):
+    """
+    Uses the emulator to pre-screen grid points before they are run.
+    Points predicted overproduced with more than n_sigma confidence are given priority
+    tier 1, to run after every tier-0 point (mode="deprioritize"), or dropped (mode="skip").
+    Returns (points_to_run, tiers, skipped_points), where tiers maps each deprioritized
+    (mass, theta) tuple to its tier. Without usable training data the points are returned unchanged.
+    """
+    if not points or not os.path.exists(results_json):
+        return list(points), {}, []
+    try:
+        emulator = load_emulator(results_json)
+    except (ValueError, np.linalg.LinAlgError) as e:
+        print(f"[emulator] Could not train emulator: {e}")
+        return list(points), {}, []
+    masses, thetas = np.array(points, dtype=float).T
+    confidence = emulator.overproduction_confidence(masses, thetas)
+    if confidence is None:
+        return list(points), {}, []
+
+    known = confidence > n_sigma
+    uncertain_points = [p for p, k in zip(points, known) if not k]
+    known_points = [p for p, k in zip(points, known) if k]
+    if known_points:
+        print(f"[emulator] {len(known_points)} of {len(points)} points predicted overproduced (> {n_sigma:g} sigma)")
+    if mode == "skip":
+        return uncertain_points, {}, known_points
+    return uncertain_points + known_points, {tuple(p): 1 for p in known_points}, []
@@ -0,0 +1,70 @@
+import os
+import glob
+import numpy as np
+from checkpoint import atomic_output
+
+def sidecar_path(path):
+    """Binary sidecar of a text file, named after the file's current mtime and size."""
+    stat = os.stat(path)
+    return f"{path}.{stat.st_mtime_ns}-{stat.st_size}.npy"
+
+def parse_table(path, comments="#"):
+    """
+    Parses a whitespace-separated numeric text table into a 2-D float array.
+    np.loadtxt uses NumPy's C tokenizer (NumPy >= 1.23), which is as fast as
+    pandas' C parser at full float precision, so no extra dependency is needed.
+    """
+    return np.loadtxt(path, comments=comments, ndmin=2)
+
+def read_table(path, comments="#", use_sidecar=True):
+    """
+    Reads a numeric text table (CLASS pk.dat, sterile-dm Snapshot100.dat, LCDM.dat, ...).
+    The parsed array is cached in a binary .npy sidecar next to the file whose name
+    carries the file's mtime and size, so later reads never re-parse the text and an
+    edited file is parsed again. Sidecars that cannot be written (e.g. read-only
+    folders) are simply skipped.
+    """
+    cache = sidecar_path(path)
+    if use_sidecar and os.path.exists(cache):
+        try:
+            return np.load(cache)
+        except (OSError, ValueError):
+            pass
+
+    table = parse_table(path, comments=comments)
+
+    if use_sidecar:
+        try:
+            with atomic_output(cache) as tmp_path:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, table)
+            for stale in glob.glob(glob.escape(path) + ".*-*.npy"):
+                if stale != cache:
+                    os.remove(stale)
+        except OSError:
+            pass
+    return table
+
+def read_last_data_line(path, comment="!", block_size=4096):
+    """
+    Returns the last non-empty, non-comment line of a text file by reading
+    backwards from the end, without scanning the whole file. None if there is none.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b""
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            lines = tail.split(b"\n")
+            # The first piece may be a partial line unless we reached the start of the file
+            candidates = lines if position == 0 else lines[1:]
+            for line in reversed(candidates):
+                text = line.decode().strip()
+                if text and not text.startswith(comment):
+                    return text
+            tail = lines[0] if position > 0 else b""
+    return None
@@ -1,12 +1,64 @@
 import os
 import json
+import textwrap
 from datetime import datetime
+import numpy as np
+from checkpoint import write_json
+from results_index import RESULTS_INDEX, TIMINGS_INDEX, append_record, read_records
+from results_store import TIMING_METRICS, merge_columns, save_store, load_results, timing_column, timed_stages
 
-def update_global_summary(results_dir="outputs", html_path="summary.html", results_json="all_results.json"):
-    """Collects all run results and generates a global HTML summary."""
-    entries = []
+PERCENTILES = (50, 90, 99)
+NESTED_STAGES = ("plot",)  # timed inside other stages, so left out of the wall-time shares
 
-    # Search all grid point results
+def summarize_timings(columns):
+    """
+    Aggregates the per-point stage timings of the store columns (see results_store) into
+    per-stage percentile tables: {stage: {"points": n, metric: {"p50", "p90", "p99", "max", "total"}}}.
+    """
+    summary = {}
+    for stage in timed_stages(columns):
+        timed = ~np.isnan(columns[timing_column(stage, "wall_s")])
+        if not timed.any():
+            continue
+        summary[stage] = {"points": int(timed.sum())}
+        for metric in TIMING_METRICS:
+            values = columns[timing_column(stage, metric)][timed]
+            stats = {f"p{q}": float(np.percentile(values, q)) for q in PERCENTILES}
+            stats["max"] = float(values.max())
+            stats["total"] = float(values.sum())
+            summary[stage][metric] = stats
+    return summary
+
+def write_timing_table(f, timing_summary):
+    """Writes the per-stage timing percentile table into an open HTML file."""
+    if not timing_summary:
+        return
+    total_wall = sum(stats["wall_s"]["total"] for stage, stats in timing_summary.items()
+                     if stage not in NESTED_STAGES) or 1.0
+    f.write("<h2>Stage Timings</h2>\n<table border='1'>\n")
+    f.write("<tr><th>Stage</th><th>Points</th><th>Wall p50 (s)</th><th>Wall p90 (s)</th><th>Wall p99 (s)</th>"
+            "<th>Wall total (s)</th><th>Share</th><th>CPU total (s)</th><th>Child CPU total (s)</th>"
+            "<th>Child peak RSS p50 / max (MB)</th><th>I/O written (MB)</th></tr>\n")
+    for stage, stats in sorted(timing_summary.items(), key=lambda item: -item[1]["wall_s"]["total"]):
+        wall = stats["wall_s"]
+        rss = stats["child_peak_rss_kb"]
+        written = (stats["io_write_bytes"]["total"] + stats["child_io_write_bytes"]["total"]) / 1e6
+        f.write(f"<tr><td>{stage}</td><td>{stats['points']}</td><td>{wall['p50']:.3g}</td><td>{wall['p90']:.3g}</td>"
+                f"<td>{wall['p99']:.3g}</td><td>{wall['total']:.4g}</td><td>{wall['total'] / total_wall:.1%}</td>"
+                f"<td>{stats['cpu_s']['total']:.4g}</td><td>{stats['child_cpu_s']['total']:.4g}</td>"
+                f"<td>{rss['p50'] / 1024:.1f} / {rss['max'] / 1024:.1f}</td><td>{written:.3g}</td></tr>\n")
+    f.write("</table>\n")
+
+def rebuild_index(results_dir="outputs"):
+    """
+    Recreates the results and timings indexes from a full scan of results_dir.
+    Only needed for campaigns produced before the indexes existed.
+    """
+    index_path = os.path.join(results_dir, RESULTS_INDEX)
+    timings_path = os.path.join(results_dir, TIMINGS_INDEX)
+    for path in (index_path, timings_path):
+        if os.path.exists(path):
+            os.remove(path)
     for folder in sorted(os.listdir(results_dir)):
         result_path = os.path.join(results_dir, folder, "results.json")
         if os.path.exists(result_path):
@@ -15,41 +67,165 @@ def update_global_summary(results_dir="outputs", html_path="summary.html", resul
             data["tag"] = folder
             timestamp = os.path.getmtime(result_path)
             data["timestamp"] = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-            entries.append(data)
+            append_record(index_path, data)
+        timing_path = os.path.join(results_dir, folder, "timings.json")
+        if os.path.exists(timing_path):
+            try:
+                with open(timing_path) as f:
+                    append_record(timings_path, {"tag": folder, "stages": json.load(f)})
+            except ValueError:
+                continue
+
+def _index_head(index_path):
+    """
+    (first line, size) of an index. A deleted and recreated index starts with a different
+    line, a truncated one is shorter than the saved offset.
+    """
+    if not os.path.exists(index_path):
+        return "", 0
+    with open(index_path) as f:
+        return f.readline(), os.path.getsize(index_path)
+
+def _load_state(state_path, paths, results_dir, heads):
+    """
+    Returns the summary state saved by the previous update of results_dir, or None if there
+    is none, one of its outputs (paths) is missing, all_results.json was changed since (e.g.
+    by an interrupted append) or the indexes were recreated since (heads: current first lines).
+    """
+    if not all(os.path.exists(path) for path in (state_path,) + paths):
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        same_indexes = all(not state[f"{name}_offset"] or
+                           (state.get(f"{name}_head") == head and size >= state[f"{name}_offset"])
+                           for name, (head, size) in heads.items())
+        if (state.get("results_dir") == os.path.abspath(results_dir) and same_indexes
+                and os.path.getsize(paths[0]) == state["results_json_size"]):
+            return state
+    except (ValueError, KeyError):
+        pass
+    return None
+
+def merge_results_json(results_json, entries, known_tags, fresh=False):
+    """
+    Adds result entries to results_json. Entries of new points are appended in place; the
+    file is only read and rewritten when one of known_tags (points already in it) was rerun,
+    or written from scratch (sorted by tag) when fresh. Returns the new file size.
+    """
+    if fresh or not os.path.exists(results_json):
+        write_json(results_json, sorted(entries, key=lambda e: e["tag"]), indent=2)
+    elif any(e["tag"] in known_tags for e in entries):
+        with open(results_json) as f:
+            existing = json.load(f)
+        latest = {e["tag"]: e for e in entries}
+        merged = [latest.pop(e["tag"], e) for e in existing] + list(latest.values())
+        write_json(results_json, merged, indent=2)
+    elif entries:
+        text = ",\n".join(textwrap.indent(json.dumps(e, indent=2), "  ") for e in entries)
+        with open(results_json, "rb+") as f:
+            # Replace the closing "\n]" (or the "]" of an empty list) with the new entries
+            f.seek(-2, os.SEEK_END)
+            if f.read(2) == b"[]":
+                f.seek(-1, os.SEEK_END)
+                f.write(f"\n{text}\n]".encode())
+            else:
+                f.seek(-2, os.SEEK_END)
+                f.write(f",\n{text}\n]".encode())
+    return os.path.getsize(results_json)
+
+def update_global_summary(results_dir="outputs", html_path="summary.html", results_json="all_results.json",
+                          timings_json="timing_summary.json", results_store="all_results.npz"):
+    """
+    Brings all_results.json, the columnar store (see results_store), the timing summary
+    and the HTML page up to date.
+    Only records appended to the results/timings indexes since the previous update are
+    read (the offsets are kept in <results_json>.state) and merged into the store, which
+    holds the per-point timings; new points are appended to all_results.json. A campaign
+    without indexes is indexed once by a full scan.
+    """
+    index_path = os.path.join(results_dir, RESULTS_INDEX)
+    timings_path = os.path.join(results_dir, TIMINGS_INDEX)
+    state_path = results_json + ".state"
+
+    if not os.path.isdir(results_dir):
+        return
+    if not os.path.exists(index_path) and not os.path.exists(timings_path):
+        rebuild_index(results_dir)
+        for path in (state_path, results_json):
+            if os.path.exists(path):
+                os.remove(path)
+
+    heads = {"results": _index_head(index_path), "timings": _index_head(timings_path)}
+    state = _load_state(state_path, (results_json, results_store, timings_json, html_path), results_dir, heads)
+    fresh = state is None
+    if fresh:
+        state = {"results_offset": 0, "timings_offset": 0}
+    new_results, state["results_offset"] = read_records(index_path, state["results_offset"])
+    new_timings, state["timings_offset"] = read_records(timings_path, state["timings_offset"])
+    if not (fresh or new_results or new_timings):
+        return
+
+    # Latest record per point wins
+    entries = {record["tag"]: record for record in new_results}
+    point_timings = {}
+    for record in new_timings:
+        point_timings.setdefault(record["tag"], {}).update(record["stages"])
 
-    # Save a central JSON
-    with open(results_json, "w") as f:
-        json.dump(entries, f, indent=2)
+    columns = {} if fresh else load_results(results_store)
+    known_tags = set(columns["tag"][columns["status"] != ""]) if columns else set()
+    results_json_size = merge_results_json(results_json, list(entries.values()), known_tags, fresh)
 
-    # Build the HTML
+    # Typed columns for whole-campaign analysis
+    columns = merge_columns(columns, list(entries.values()), point_timings)
+    save_store(results_store, columns)
+
+    timing_summary = summarize_timings(columns)
+    with open(timings_json, "w") as f:
+        json.dump(timing_summary, f, indent=2)
+
+    render_summary_html(columns, timing_summary, results_dir, html_path)
+
+    write_json(state_path, {"results_dir": os.path.abspath(results_dir), "results_offset": state["results_offset"],
+                            "timings_offset": state["timings_offset"], "results_json_size": results_json_size,
+                            "results_head": heads["results"][0], "timings_head": heads["timings"][0]})
+
+def _number(value, fmt):
+    return "N/A" if np.isnan(value) else format(value, fmt)
+
+def render_summary_html(columns, timing_summary, results_dir="outputs", html_path="summary.html"):
+    """Writes the global HTML summary page from the store columns (points with a result, by tag)."""
+    link_dir = os.path.relpath(results_dir, os.path.dirname(os.path.abspath(html_path)))
+    rows = [row for row in np.argsort(columns["tag"], kind="stable") if columns["status"][row]]
     with open(html_path, "w") as f:
         f.write("<html><body><h1>Global Neutrino Pipeline Summary</h1>\n")
         f.write("<table border='1'>\n")
         f.write("<tr><th>Tag</th><th>Mass (keV)</th><th>Mixing</th><th>Lepton #</th><th>Thermal Mass</th><th>DM Density</th><th>Timestamp</th></tr>\n")
         
-        for entry in entries:
-            tag_link = f"<a href='outputs/{entry['tag']}/summary.html'>{entry['tag']}</a>"
-            mass = f"{entry['mass_keV']:.2e}"
-            mixing = f"{entry['mixing_angle']:.1e}"
-            L = f"{entry['lepton_asymmetry']:.2e}"
-            
-            # Handle SKIPPED thermal mass
-            thermal_mass = entry['thermal_mass']
-            if isinstance(thermal_mass, (float, int)):
-                thermal_mass_str = f"{thermal_mass:.2f}"
-            else:
-                thermal_mass_str = f"<i>{thermal_mass}</i>"
+        for row in rows:
+            tag = columns["tag"][row]
+            tag_link = f"<a href='{link_dir}/{tag}/summary.html'>{tag}</a>"
+            mass = f"{columns['mass_keV'][row]:.2e}"
+            mixing = f"{columns['mixing_angle'][row]:.1e}"
+            L = _number(columns["lepton_asymmetry"][row], ".2e")
 
-            # Format DM density
-            dm_density = entry.get("dm_density", "N/A")
-            if isinstance(dm_density, (float, int)):
-                dm_density_str = f"{dm_density:.3g}"
+            # Handle SKIPPED thermal mass (NaN in the store)
+            thermal_mass = columns["thermal_mass"][row]
+            if np.isnan(thermal_mass):
+                thermal_mass_str = "<i>SKIPPED</i>"
             else:
-                dm_density_str = str(dm_density)
+                thermal_mass_str = f"{thermal_mass:.2f}"
 
-            time_str = entry["timestamp"]
+            dm_density_str = _number(columns["dm_density"][row], ".3g")
+            time_str = columns["timestamp"][row]
 
             f.write(f"<tr><td>{tag_link}</td><td>{mass}</td><td>{mixing}</td><td>{L}</td>")
             f.write(f"<td>{thermal_mass_str}</td><td>{dm_density_str}</td><td>{time_str}</td></tr>\n")
 
-        f.write("</table></body></html>")
+        f.write("</table>\n")
+        write_timing_table(f, timing_summary)
+        f.write("</body></html>")
+
+if __name__ == "__main__":
+    from config import base_output_dir
+    update_global_summary(base_output_dir)
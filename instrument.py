@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+from results_index import append_timings
+from checkpoint import write_json
+
+# Timings of the grid point currently being processed in this process (see begin_point)
+_point = None
+# Stage timings of the last point finished by end_point in this process
+_last_stages = None
+
+def _self_io():
+    """(read_bytes, write_bytes) of this process from /proc/self/io, or (0, 0) where unavailable."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("read_bytes", 0), counters.get("write_bytes", 0)
+
+def _empty_record():
+    return {
+        "calls": 0,
+        "wall_s": 0.0,
+        "cpu_s": 0.0,
+        "child_cpu_s": 0.0,
+        "child_peak_rss_kb": 0,
+        "self_peak_rss_kb": 0,
+        "io_read_bytes": 0,
+        "io_write_bytes": 0,
+        "child_io_read_bytes": 0,
+        "child_io_write_bytes": 0,
+    }
+
+class PointTimings:
+    """
+    Per-stage resource usage of one grid point, stored in output_dir/timings.json.
+    Stages may nest (e.g. "plot" inside "modify_psd"); child-process usage is charged
+    to the innermost open stage. Repeated stages accumulate.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.stages = {}
+        self._open = []
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, _empty_record())
+        children = {"cpu_s": 0.0, "peak_rss_kb": 0, "read_bytes": 0, "write_bytes": 0}
+        self._open.append(children)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        read0, write0 = _self_io()
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            read1, write1 = _self_io()
+            record["calls"] += 1
+            record["wall_s"] += time.perf_counter() - wall0
+            record["cpu_s"] += time.process_time() - cpu0
+            record["io_read_bytes"] += read1 - read0
+            record["io_write_bytes"] += write1 - write0
+            record["child_cpu_s"] += children["cpu_s"]
+            record["child_peak_rss_kb"] = max(record["child_peak_rss_kb"], children["peak_rss_kb"])
+            record["child_io_read_bytes"] += children["read_bytes"]
+            record["child_io_write_bytes"] += children["write_bytes"]
+            record["self_peak_rss_kb"] = max(record["self_peak_rss_kb"],
+                                             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def add_child(self, rusage):
+        """Charges a reaped child's resource usage to the innermost open stage."""
+        if not self._open:
+            return
+        children = self._open[-1]
+        children["cpu_s"] += rusage.ru_utime + rusage.ru_stime
+        children["peak_rss_kb"] = max(children["peak_rss_kb"], rusage.ru_maxrss)
+        children["read_bytes"] += rusage.ru_inblock * 512
+        children["write_bytes"] += rusage.ru_oublock * 512
+
+    def write(self):
+        """Merges these stages into output_dir/timings.json (stages of a point run one after another)."""
+        path = os.path.join(self.output_dir, "timings.json")
+        existing = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    existing = json.load(f)
+            except ValueError:
+                existing = {}
+        existing.update(self.stages)
+        write_json(path, existing, indent=4)
+
+def begin_point(output_dir):
+    """Starts recording stage timings for a grid point in this process."""
+    global _point, _last_stages
+    _point = PointTimings(output_dir)
+    _last_stages = None
+    return _point
+
+def end_point():
+    """Writes the current point's timings.json, appends them to the timings index and stops recording."""
+    global _point, _last_stages
+    if _point is not None:
+        _last_stages = _point.stages
+        os.makedirs(_point.output_dir, exist_ok=True)
+        _point.write()
+        if _point.stages:
+            append_timings(_point.output_dir, _point.stages)
+    _point = None
+
+def last_stages():
+    """{stage: record} timings of the last point finished in this process, or {}."""
+    return _last_stages or {}
+
+@contextmanager
+def stage(name):
+    """Times a stage of the current point; a no-op outside begin_point/end_point."""
+    if _point is None:
+        yield None
+    else:
+        with _point.stage(name) as record:
+            yield record
+
+def wait_child(proc):
+    """
+    Waits for a Popen child with os.wait4 so its own CPU time, peak RSS and block I/O
+    can be charged to the current stage. Returns (and sets) proc.returncode.
+    """
+    if proc.returncode is not None:
+        return proc.returncode
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # Already reaped elsewhere; fall back to Popen's own bookkeeping
+        return proc.wait()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if _point is not None:
+        _point.add_child(rusage)
+    return proc.returncode
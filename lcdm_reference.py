@@ -0,0 +1,78 @@
+import os
+import fcntl
+from config import base_output_dir, class_path
+from prepare_class_input import lcdm_class_parameters, write_class_ini
+from run_class import run_class, run_class_classy, class_input_key, classy_cosmology, classy_pk
+from artifact_cache import fetch, store
+
+# LCDM reference spectra generated with CLASS from the sterile runs' own parameters, one per
+# (cosmology, precision profile, k range, CLASS build):
+#   base_output_dir/lcdm_reference/<key>/pk.dat   (pk.npy with the classy backend)
+# CLASS picks its k nodes per cosmology, so a stored reference is interpolated onto each
+# sterile spectrum; with classy the reference is instead evaluated at the sterile nodes.
+REFERENCE_DIR = "lcdm_reference"
+
+# Reference paths already generated or found by this process, keyed by input key
+_references = {}
+# classy LCDM cosmologies computed by this process, keyed by input key
+_classy_references = {}
+
+def lcdm_reference_key(profile="full", k_range=None, backend="executable"):
+    """Input key of the LCDM reference matching CLASS runs at this profile and k range."""
+    params = lcdm_class_parameters(profile, k_range)
+    fd_psd = os.path.join(class_path, "psd_FD_single.dat")
+    return class_input_key(params, [fd_psd] if os.path.exists(fd_psd) else [], backend)
+
+def _find_spectrum(ref_dir):
+    for name in ("pk.dat", "pk.npy"):
+        path = os.path.join(ref_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+def ensure_lcdm_reference(profile="full", k_range=None, backend="executable", results_dir=base_output_dir):
+    """
+    Path of the LCDM reference spectrum for CLASS runs at this profile and k range.
+    On first use it is restored from the artifact cache or computed with CLASS; a lock
+    file makes concurrent workers (on any node) wait for a single run.
+    """
+    key = lcdm_reference_key(profile, k_range, backend)
+    if key in _references and os.path.exists(_references[key]):
+        return _references[key]
+    ref_dir = os.path.abspath(os.path.join(results_dir, REFERENCE_DIR, key[:16]))
+    os.makedirs(ref_dir, exist_ok=True)
+    with open(os.path.join(ref_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = _find_spectrum(ref_dir)
+        if path is None:
+            if fetch("lcdm", key, ref_dir) is not None:
+                print(f"Reusing cached LCDM reference ({profile}).")
+            else:
+                print(f"Generating the LCDM reference with CLASS ({profile})...")
+                params = lcdm_class_parameters(profile, k_range)
+                if backend == "classy":
+                    run_class_classy(params, ref_dir)
+                else:
+                    ini_path = write_class_ini(params, os.path.join(ref_dir, "lcdm.ini"),
+                                               os.path.join(ref_dir, "output", "lcdm_"),
+                                               "CLASS input for the LCDM reference")
+                    run_class(ini_path, ref_dir)
+                if _find_spectrum(ref_dir) is None:
+                    raise FileNotFoundError("CLASS did not produce the LCDM reference spectrum.")
+                store("lcdm", key, [_find_spectrum(ref_dir)])
+            path = _find_spectrum(ref_dir)
+    _references[key] = path
+    return path
+
+def classy_reference(profile="full", k_range=None):
+    """
+    The LCDM reference for CLASS runs at this profile and k range as a function P(k),
+    evaluated by classy at any k [h/Mpc], so transfer functions need no interpolation.
+    The cosmology is computed once per process.
+    """
+    key = lcdm_reference_key(profile, k_range, "classy")
+    if key not in _classy_references:
+        print(f"Computing the LCDM reference with classy ({profile})...")
+        _classy_references[key] = classy_cosmology(lcdm_class_parameters(profile, k_range))
+    cosmo = _classy_references[key]
+    return lambda k: classy_pk(cosmo, k)
@@ -1,63 +1,77 @@
-from multiprocessing import Pool, cpu_count, Manager
-import time
 import os
-from config import mass_grid, theta_grid
-from runner import process_grid_point
+import fcntl
+import argparse
+from config import mass_grid, theta_grid, base_output_dir, adaptive_grid, emulator_screening, emulator_sigma, save_plots, plot_niceness
+from scheduler import Scheduler
 from global_summary import update_global_summary
+from utils import point_tag
 
 param_grid = [(m, theta) for m in mass_grid for theta in theta_grid]
 status_file = "pipeline_status.json"
 
-def print_progress(progress_dict, total):
-    completed = sum(1 for status in progress_dict.values() if status == "done")
-    running = sum(1 for status in progress_dict.values() if status == "running")
-    failed = sum(1 for status in progress_dict.values() if status == "error")
-    print(f"Progress: {completed}/{total} completed | {running} running | {failed} failed")
-
-def wrapped_process(mass, theta, progress_dict):
-    tag = f"m_{mass:.1e}_theta_{theta:.1e}"
-    progress_dict[tag] = "running"
-    try:
-        process_grid_point(mass, theta)
-        # Only mark as done if results.json was created
-        result_path = os.path.join("outputs", tag, "results.json")
-        if os.path.exists(result_path):
-            progress_dict[tag] = "done"
-        else:
-            progress_dict[tag] = "error"
-    except Exception as e:
-        progress_dict[tag] = "error"
-        error_dir = os.path.join("outputs", tag)
-        os.makedirs(error_dir, exist_ok=True)
-        with open(os.path.join(error_dir, "error.log"), "a") as log:
-            log.write(str(e) + "\n")
-        with open(os.path.join(error_dir, ".fail"), "w") as f:
-            f.write("FAILED\n")
+def screened(points):
+    """
+    Drops or deprioritizes points the emulator predicts to overproduce, when emulator
+    screening is on. Returns (points, tiers); see emulator.screen_points.
+    """
+    if not emulator_screening:
+        return points, {}
+    from emulator import screen_points
+    points, tiers, skipped = screen_points(points, mode=emulator_screening, n_sigma=emulator_sigma)
+    for m, theta in skipped:
+        print(f"[{point_tag(m, theta)}] Skipped: emulator predicts overproduction.")
+    return points, tiers
 
+def run_points(points):
+    """Runs the pipeline for a list of (mass_keV, theta) points with the stage scheduler."""
+    points, tiers = screened(points)
+    return Scheduler().run(points, tiers=tiers)
 
-def run_all():
-    total = len(param_grid)
-
-    with Manager() as manager:
-        progress = manager.dict()
+def finish_campaign():
+    update_global_summary(base_output_dir)
+    if save_plots:
+        from plots import render_in_background
+        render_in_background(base_output_dir, plot_niceness)
+        print("Rendering plots in the background (python plots.py renders any left over).")
 
-        with Pool(cpu_count()) as pool:
-            results = [
-                pool.apply_async(wrapped_process, args=(m, theta, progress))
-                for m, theta in param_grid
-            ]
-
-            while any(not r.ready() for r in results):
-                print_progress(progress, total)
-                time.sleep(5)
+def run_all():
+    if adaptive_grid:
+        from adaptive import run_adaptive
+        run_adaptive(run_points)
+    else:
+        run_points(param_grid)
+    finish_campaign()
 
-            # Wait for all to finish
-            for r in results:
-                r.wait()
+def enqueue_grid(retry_failed=False):
+    """Adds the grid to the shared work queue for distributed workers."""
+    from work_queue import enqueue
+    from scheduler import RuntimeModel
+    points, tiers = screened(param_grid)
+    added = enqueue(points, RuntimeModel(), retry_failed=retry_failed, tiers=tiers)
+    print(f"Queued {added} new grid points in {os.path.join(base_output_dir, 'queue')}.")
 
-        # Final update
-        print_progress(progress, total)
-        update_global_summary()
+def run_worker(jobs):
+    """
+    Pulls points from the shared queue until it is drained. The worker that sees the
+    queue drained last brings the global summary up to date.
+    """
+    from work_queue import run_workers, queue_dir, queue_finished
+    run_workers(jobs)
+    with open(os.path.join(queue_dir(), "summary.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if queue_finished():
+            finish_campaign()
 
 if __name__ == "__main__":
-    run_all()
+    parser = argparse.ArgumentParser(description="Sterile neutrino grid pipeline.")
+    parser.add_argument("--enqueue", action="store_true", help="add the grid to the shared work queue in base_output_dir/queue")
+    parser.add_argument("--retry-failed", action="store_true", help="with --enqueue, move failed points back to pending")
+    parser.add_argument("--worker", action="store_true", help="pull points from the shared work queue (any number of nodes)")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes started by --worker")
+    args = parser.parse_args()
+    if args.enqueue:
+        enqueue_grid(args.retry_failed)
+    if args.worker:
+        run_worker(args.jobs)
+    if not (args.enqueue or args.worker):
+        run_all()
@@ -0,0 +1,87 @@
+import os
+import sys
+import glob
+import subprocess
+import numpy as np
+from checkpoint import atomic_output
+
+# Workers only save plot data (plots/<name>.npz); PNGs are rendered here in batch,
+# off the grid's critical path, reusing a single Agg figure.
+
+def save_plot_data(plot_dir, name, **arrays):
+    """Saves the arrays needed to draw plot `name` to plot_dir/<name>.npz (atomically, see checkpoint)."""
+    os.makedirs(plot_dir, exist_ok=True)
+    with atomic_output(os.path.join(plot_dir, f"{name}.npz")) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+
+def _draw_psd_plot(fig, data):
+    ax = fig.add_subplot()
+    q, f = data["q"], data["f"]
+    ax.plot(q, q**2 * f)
+    ax.set_xlabel("q = p/T")
+    ax.set_ylabel(r"$q^2 f(q)$")
+    ax.set_title("Modified and Smoothed PSD")
+
+def _draw_transfer_fit(fig, data):
+    ax = fig.add_subplot()
+    ax.scatter(data["k"], data["T"], s=10, label="T(k)")
+    ax.plot(data["k"], data["T_fit"], 'r--', label=f"Fit t={float(data['t_fit']):.2f}")
+    ax.set_xscale('log')
+    ax.set_xlabel("k [h/Mpc]")
+    ax.set_ylabel("Relative Transfer T(k)")
+    ax.set_title("Transfer Function Fit")
+    ax.legend()
+    fig.tight_layout()
+
+PLOT_RENDERERS = {
+    "psd_plot": _draw_psd_plot,
+    "transfer_fit": _draw_transfer_fit,
+}
+
+def pending_plots(results_dir):
+    """Lists plot data files whose PNG is missing or older than the data."""
+    pending = []
+    for data_path in sorted(glob.glob(os.path.join(results_dir, "*", "plots", "*.npz"))):
+        name = os.path.splitext(os.path.basename(data_path))[0]
+        if name not in PLOT_RENDERERS:
+            continue
+        png_path = os.path.splitext(data_path)[0] + ".png"
+        if not os.path.exists(png_path) or os.path.getmtime(png_path) < os.path.getmtime(data_path):
+            pending.append(data_path)
+    return pending
+
+def render_plots(results_dir):
+    """Renders all pending plots under results_dir with one reused Agg figure and canvas."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    pending = pending_plots(results_dir)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    rendered = 0
+    for data_path in pending:
+        name = os.path.splitext(os.path.basename(data_path))[0]
+        try:
+            with np.load(data_path) as data:
+                fig.clf()
+                PLOT_RENDERERS[name](fig, data)
+            with atomic_output(os.path.splitext(data_path)[0] + ".png") as tmp_path:
+                fig.savefig(tmp_path, format="png")
+            rendered += 1
+        except Exception as e:
+            print(f"[plots] Failed to render {data_path}: {e}")
+    print(f"[plots] Rendered {rendered}/{len(pending)} plots in {results_dir}")
+    return rendered
+
+def render_in_background(results_dir, niceness=10):
+    """Starts the batch renderer as a detached low-priority process and returns it."""
+    args = [sys.executable, os.path.abspath(__file__), results_dir, str(niceness)]
+    return subprocess.Popen(args, start_new_session=True)
+
+if __name__ == "__main__":
+    from config import base_output_dir
+    results_dir = sys.argv[1] if len(sys.argv) > 1 else base_output_dir
+    if len(sys.argv) > 2:
+        os.nice(int(sys.argv[2]))
+    render_plots(results_dir)
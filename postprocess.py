@@ -1,20 +1,40 @@
 import os
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
 from config import save_plots
+from instrument import stage
+from fastio import read_table
+from plots import save_plot_data
+from results_index import RESULTS_INDEX, read_records
+from checkpoint import atomic_output
 
 # Parameters for transfer function fitting (from Vogel et al. 2022)
 a, b, v = 0.0437, -1.188, 1.049
 
+# Dodelson-Widrow scaling between sterile and thermal mass, m_s = 4.43 keV t^(4/3)
+DW_MASS_EXPONENT = 0.75
+
+# Reference spectra loaded once per process, keyed by path and file (mtime, size)
+_reference_cache = {}
+
+# References already reported as interpolated onto other k nodes, so the note is printed once per reference
+_interpolated_references = set()
+
+# Latest thermal mass per (mass, theta) seen in each results index by this process,
+# keyed by index path: {"offset": bytes read, "latest": {(mass, theta): t}, "head": first line}
+_neighbour_cache = {}
+
 def load_power_spectrum(path):
     """
     Load power spectrum data from a CLASS output file, skipping comment lines.
+    Also accepts a .npy array saved by the classy backend. Text files are parsed once
+    and then read from their binary sidecar (see fastio.read_table).
     Returns only the first two columns (k and P(k)).
     """
     try:
-        data = np.loadtxt(path, comments="#")
+        if path.endswith(".npy"):
+            data = np.load(path)
+        else:
+            data = read_table(path, comments="#")
         if data.shape[1] < 2:
             raise ValueError(f"{path} does not contain two columns.")
         return data[:, 0], data[:, 1]
@@ -22,23 +42,72 @@ def load_power_spectrum(path):
         print(f"Error loading {path}: {e}")
         raise
 
+def _as_spectrum(source):
+    """Returns (k, P) from a file path or an in-memory (k, P) pair."""
+    if isinstance(source, (str, os.PathLike)):
+        return load_power_spectrum(os.fspath(source))
+    k, P = source
+    return np.asarray(k, dtype=float), np.asarray(P, dtype=float)
+
+def _loglog_interpolator(k, P):
+    """Builds a log-log linear interpolator P(k) that returns NaN outside the sampled k range."""
+    k, P = np.asarray(k, dtype=float), np.asarray(P, dtype=float)
+    keep = (k > 0) & (P > 0)
+    order = np.argsort(k[keep])
+    log_k, log_P = np.log(k[keep])[order], np.log(P[keep])[order]
+    def interp(k_eval):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.exp(np.interp(np.log(k_eval), log_k, log_P, left=np.nan, right=np.nan))
+    return interp
+
+def load_reference_spectrum(path):
+    """
+    Returns (k, P, interpolator) for a reference spectrum such as LCDM.dat.
+    The file is parsed and the log-log interpolator built at most once per process;
+    the cache entry is invalidated if the file's mtime or size changes.
+    """
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _reference_cache.get(abs_path)
+    if cached is None or cached[0] != key:
+        k, P = load_power_spectrum(abs_path)
+        cached = (key, (k, P, _loglog_interpolator(k, P)))
+        _reference_cache[abs_path] = cached
+    return cached[1]
+
 def extract_transfer_function(test_path, lcdm_path):
     """
-    Compute T(k) = sqrt(P_test(k) / P_LCDM(k)) using interpolation on a shared k-grid.
+    Compute T(k) = sqrt(P_test(k) / P_LCDM(k)) on the test spectrum's own k nodes.
+    A reference given as a function P(k) (classy, see lcdm_reference.classy_reference) is
+    evaluated at the test nodes. A reference on the same nodes is divided elementwise;
+    otherwise it is interpolated in log-log space onto the test nodes, and nodes outside
+    its k range are dropped instead of extrapolated.
+    A reference given as a path is loaded once per process (see load_reference_spectrum).
+    Either spectrum may be a file path or an in-memory (k, P) pair, e.g. from the classy backend.
     Filters out invalid values (NaNs, infs, negatives).
     """
-    k_test, P_test = load_power_spectrum(test_path)
-    k_lcdm, P_lcdm = load_power_spectrum(lcdm_path)
-
-    k_common = np.unique(np.concatenate((k_test, k_lcdm)))
-    P_test_interp = interp1d(k_test, P_test, bounds_error=False, fill_value="extrapolate")
-    P_lcdm_interp = interp1d(k_lcdm, P_lcdm, bounds_error=False, fill_value="extrapolate")
-
-    P_test_vals = P_test_interp(k_common)
-    P_lcdm_vals = P_lcdm_interp(k_common)
+    k_test, P_test = _as_spectrum(test_path)
+    if callable(lcdm_path):
+        P_lcdm_vals = np.asarray(lcdm_path(k_test), dtype=float)
+    else:
+        if isinstance(lcdm_path, (str, os.PathLike)):
+            k_lcdm, P_lcdm, P_lcdm_interp = load_reference_spectrum(lcdm_path)
+        else:
+            k_lcdm, P_lcdm = _as_spectrum(lcdm_path)
+            P_lcdm_interp = None
+        if k_lcdm.shape == k_test.shape and np.allclose(k_lcdm, k_test, rtol=1e-8, atol=0):
+            P_lcdm_vals = P_lcdm
+        else:
+            ref_id = os.fspath(lcdm_path) if isinstance(lcdm_path, (str, os.PathLike)) else None
+            if ref_id not in _interpolated_references:
+                _interpolated_references.add(ref_id)
+                print(f"[extract_transfer_function] Reference k nodes ({len(k_lcdm)}) differ from the spectrum's "
+                      f"({len(k_test)}); interpolating the reference in log-log space.")
+            P_lcdm_vals = (P_lcdm_interp or _loglog_interpolator(k_lcdm, P_lcdm))(k_test)
 
     # Clip negative P_test values
-    P_test_vals = np.clip(P_test_vals, a_min=0, a_max=None)
+    P_test_vals = np.clip(P_test, a_min=0, a_max=None)
 
     # Avoid divide-by-zero and bad sqrt
     with np.errstate(divide='ignore', invalid='ignore'):
@@ -49,12 +118,10 @@ def extract_transfer_function(test_path, lcdm_path):
         raise ValueError("All transfer function points are invalid. Nothing to fit.")
 
     if np.sum(~valid) > 0:
-        print(f"[extract_transfer_function] Warning: Skipped {np.sum(~valid)} bad T(k) points")
+        print(f"[extract_transfer_function] Warning: Skipped {np.sum(~valid)} bad or out-of-range T(k) points")
 
     T_k = np.sqrt(ratio[valid])
-    return k_common[valid], T_k
-
-
+    return k_test[valid], T_k
 
 def _fit_model(k, t):
     """
@@ -62,27 +129,222 @@ def _fit_model(k, t):
     """
     return (1 + (a * k * t**b)**(2*v))**(-5/v)
 
-def fit_thermal_mass(k, T, output_dir=None):
+def analytic_thermal_mass(k, T, model_params=None, t_max_level=0.95):
+    """
+    Analytic estimate of t by inverting the model at one data point: T = y at
+    a k t^b = (y^(-v/5) - 1)^(1/(2v)). Uses the half-mode crossing T = 1/2
+    (interpolated in log k) when the data reach it, otherwise the lowest T below
+    t_max_level (heavy t, whose suppression starts near k_max). Returns None if T(k)
+    stays above t_max_level.
+    """
+    a_, b_, v_ = model_params or (a, b, v)
+    k, T = np.asarray(k, dtype=float), np.asarray(T, dtype=float)
+    ok = np.isfinite(T) & (T > 0) & (k > 0)
+    k, T = k[ok], T[ok]
+    below = np.nonzero(T < 0.5)[0]
+    if below.size and below[0] > 0:
+        i = below[0]
+        frac = (T[i-1] - 0.5) / (T[i-1] - T[i])
+        k_y = np.exp(np.log(k[i-1]) + frac * (np.log(k[i]) - np.log(k[i-1])))
+        y = 0.5
+    else:
+        if not T.size or T.min() >= t_max_level:
+            return None
+        i = np.argmin(T)
+        k_y, y = k[i], T[i]
+    x = (y**(-v_/5) - 1)**(1 / (2*v_))
+    return float((x / (a_ * k_y))**(1 / b_))
+
+def expected_thermal_mass(sterile_mass_keV):
+    """Rough t for a sterile mass before any fit, from the Dodelson-Widrow relation."""
+    return (sterile_mass_keV / 4.43)**DW_MASS_EXPONENT
+
+def neighbour_fit_start(mass_keV, theta, results_dir, n_neighbours=4, margin=2.0):
+    """
+    Start value and bounds for t from the nearest finished grid points in
+    (log mass, log theta), read from the results index of results_dir (cached per process,
+    so each call only reads the records appended since the last one). Each neighbour's t
+    is first scaled to this mass with the Dodelson-Widrow exponent.
+    p0 is the inverse-distance weighted geometric mean of the scaled t; the bounds span
+    their range widened by `margin`. Returns (None, None) without usable neighbours.
+    """
+    index_path = os.path.join(results_dir, RESULTS_INDEX)
+    head = ""
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            head = f.readline()
+    cached = _neighbour_cache.get(index_path)
+    # A recreated index starts with a different record
+    if cached is None or cached["head"] != head:
+        cached = _neighbour_cache[index_path] = {"offset": 0, "latest": {}, "head": head}
+    # Only the records appended since the previous call are read
+    records, cached["offset"] = read_records(index_path, cached["offset"])
+    latest = cached["latest"]
+    for record in records:
+        latest[(record["mass_keV"], record["mixing_angle"])] = record.get("thermal_mass")
+    points = np.array([(m, th, t) for (m, th), t in latest.items()
+                       if isinstance(t, (int, float)) and t > 0 and (m, th) != (mass_keV, theta)], dtype=float)
+    if not len(points):
+        return None, None
+    dist = np.hypot(np.log10(points[:, 0] / mass_keV), np.log10(points[:, 1] / theta))
+    nearest = np.argsort(dist)[:n_neighbours]
+    log_t = np.log(points[nearest, 2]) + DW_MASS_EXPONENT * np.log(mass_keV / points[nearest, 0])
+    weights = 1 / np.maximum(dist[nearest], 1e-6)
+    p0 = float(np.exp(np.average(log_t, weights=weights)))
+    return p0, (float(np.exp(log_t.min()) / margin), float(np.exp(log_t.max()) * margin))
+
+def fit_thermal_mass(k, T, output_dir=None, p0=None, bounds=None, return_info=False):
     """
     Fit T(k) to extract the thermal mass parameter t.
-    Optionally saves a plot in output_dir if save_plots is True.
+    The fit starts from whichever of the analytic estimate (see analytic_thermal_mass) and
+    p0 (e.g. a coarser fit of the same point, or neighbouring grid points) has the lower
+    initial residual; from the one available if only one is, else from t = 1.
+    bounds (t_min, t_max) narrow the search; they are dropped again if the fit ends on one.
+    With return_info=True, returns (t, info) where info holds the start value, its source
+    and the number of model evaluations (nfev).
+    Optionally saves the plot data to output_dir/plots if save_plots is True; the PNG
+    is rendered later by plots.render_plots.
     """
-    popt, _ = curve_fit(_fit_model, k, T, p0=[1.0])
+    from scipy.optimize import curve_fit
+
+    candidates = [(t, source) for t, source in ((analytic_thermal_mass(k, T), "analytic"), (p0, "given"))
+                  if t is not None and t > 0]
+    start, source = 1.0, "default"
+    if candidates:
+        with np.errstate(invalid="ignore", over="ignore"):
+            residuals = [np.nansum((_fit_model(k, t) - T)**2) for t, _ in candidates]
+        start, source = candidates[int(np.argmin(residuals))]
+    p0 = start
+    if bounds is not None and not bounds[0] < p0 < bounds[1]:
+        bounds = None
+
+    nfev = 0
+    if bounds is not None:
+        popt, _, info, *_ = curve_fit(_fit_model, k, T, p0=[p0], bounds=bounds, full_output=True)
+        nfev += info["nfev"]
+        if np.isclose(popt[0], bounds, rtol=1e-6).any():
+            bounds = None
+    if bounds is None:
+        popt, _, info, *_ = curve_fit(_fit_model, k, T, p0=[p0], full_output=True)
+        nfev += info["nfev"]
     t_fit = popt[0]
 
     if save_plots and output_dir:
-        plot_dir = os.path.join(output_dir, "plots")
-        os.makedirs(plot_dir, exist_ok=True)
-        plt.figure()
-        plt.scatter(k, T, s=10, label="T(k)")
-        plt.plot(k, _fit_model(k, t_fit), 'r--', label=f"Fit t={t_fit:.2f}")
-        plt.xscale('log')
-        plt.xlabel("k [h/Mpc]")
-        plt.ylabel("Relative Transfer T(k)")
-        plt.title("Transfer Function Fit")
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig(os.path.join(plot_dir, "transfer_fit.png"))
-        plt.close()
+        with stage("plot"):
+            save_plot_data(os.path.join(output_dir, "plots"), "transfer_fit",
+                           k=k, T=T, T_fit=_fit_model(k, t_fit), t_fit=t_fit)
 
+    if return_info:
+        return t_fit, {"p0": float(p0), "p0_source": source, "nfev": int(nfev)}
     return t_fit
+
+def save_transfer_function(output_dir, k, T):
+    """Saves a point's T(k) to output_dir/transfer.npz so the campaign can be refit in batch."""
+    with atomic_output(os.path.join(output_dir, "transfer.npz")) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, k=np.asarray(k), T=np.asarray(T))
+
+def _model_and_dlogt(log_ak, log_t, model_params):
+    """
+    Vectorized transfer-function model and its derivative with respect to ln t,
+    evaluated from log(a k). log_ak broadcasts against log_t, e.g. shapes (nk,) and (N, 1).
+    """
+    _, b_, v_ = model_params
+    u = np.exp(2*v_ * (log_ak + b_ * log_t))
+    base = 1 + u
+    model = base**(-5/v_)
+    dmodel = -10 * b_ * u * model / base
+    return model, dmodel
+
+def fit_thermal_mass_batch(k, T_stack, model_params=None, t_range=(0.1, 1000.0), n_grid=400, max_iter=50, tol=1e-8,
+                           t0=None):
+    """
+    Fit t for many transfer functions sampled on a common k grid at once.
+    T_stack has shape (N, len(k)); NaN entries are ignored, so points may cover
+    different k ranges. Each row starts from its finite entry of t0 (e.g. the analytic
+    estimate) or else from a vectorized log-space grid search over t_range, and is
+    refined with Gauss-Newton steps in ln t, kept within t_range.
+    model_params defaults to the module-level (a, b, v).
+    Returns (t, sigma_t) arrays; sigma_t matches curve_fit's default covariance.
+    Rows with fewer than two valid points get NaN.
+    """
+    if model_params is None:
+        model_params = (a, b, v)
+    log_ak = np.log(model_params[0] * np.asarray(k, dtype=float))
+    T_stack = np.atleast_2d(np.asarray(T_stack, dtype=float))
+    weight = np.isfinite(T_stack).astype(float)
+    T0 = np.where(weight > 0, T_stack, 0.0)
+    n_valid = weight.sum(axis=1)
+    log_lo, log_hi = np.log(t_range[0]), np.log(t_range[1])
+
+    log_t = np.full(len(T_stack), np.nan)
+    if t0 is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_t = np.clip(np.log(np.asarray(t0, dtype=float)), log_lo, log_hi)
+    unseeded = ~np.isfinite(log_t)
+
+    # === Grid search: SSE = sum(w T^2) - 2 sum(w T M) + sum(w M^2) for every (point, t) pair ===
+    if unseeded.any():
+        log_grid = np.linspace(log_lo, log_hi, n_grid)
+        M_grid, _ = _model_and_dlogt(log_ak, log_grid[:, None], model_params)
+        T_u, w_u = T0[unseeded], weight[unseeded]
+        sse = (T_u**2).sum(axis=1)[:, None] - 2 * T_u @ M_grid.T + w_u @ (M_grid**2).T
+        log_t[unseeded] = log_grid[np.argmin(sse, axis=1)]
+
+    # === Gauss-Newton refinement in ln t, only on rows that have not converged ===
+    active = np.arange(len(log_t))
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        w, T_a = weight[active], T0[active]
+        model, dmodel = _model_and_dlogt(log_ak, log_t[active, None], model_params)
+        jtj = (w * dmodel**2).sum(axis=1)
+        jtr = (w * dmodel * (T_a - model)).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(jtj > 0, jtr / jtj, 0.0)
+        new_log_t = np.clip(log_t[active] + np.clip(step, -0.5, 0.5), log_lo, log_hi)
+        moved = np.abs(new_log_t - log_t[active])
+        log_t[active] = new_log_t
+        active = active[moved >= tol]
+
+    model, dmodel = _model_and_dlogt(log_ak, log_t[:, None], model_params)
+    sse = (weight * (T0 - model)**2).sum(axis=1)
+    jtj = (weight * dmodel**2).sum(axis=1)
+    t = np.exp(log_t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_t = t * np.sqrt(sse / (n_valid - 1) / jtj)
+
+    bad = n_valid < 2
+    t[bad] = np.nan
+    sigma_t[bad] = np.nan
+    return t, sigma_t
+
+def refit_thermal_masses(results_dir="outputs", model_params=None, n_k=200):
+    """
+    Refits every saved transfer.npz under results_dir in one batch.
+    Each T(k) is interpolated in log k onto a shared log-spaced grid (NaN outside its
+    own k range) and passed to fit_thermal_mass_batch, seeded with the analytic estimate.
+    Returns {tag: (t, sigma_t)}.
+    """
+    tags, curves = [], []
+    for folder in sorted(os.listdir(results_dir)):
+        path = os.path.join(results_dir, folder, "transfer.npz")
+        if os.path.exists(path):
+            with np.load(path) as data:
+                curves.append((data["k"], data["T"]))
+            tags.append(folder)
+    if not tags:
+        return {}
+
+    k_min = min(k_i.min() for k_i, _ in curves)
+    k_max = max(k_i.max() for k_i, _ in curves)
+    k_grid = np.logspace(np.log10(k_min), np.log10(k_max), n_k)
+    T_stack = np.vstack([
+        np.interp(np.log(k_grid), np.log(k_i), T_i, left=np.nan, right=np.nan)
+        for k_i, T_i in curves
+    ])
+
+    t0 = [analytic_thermal_mass(k_i, T_i, model_params) for k_i, T_i in curves]
+    t0 = np.array([np.nan if t_i is None else t_i for t_i in t0])
+    t, sigma_t = fit_thermal_mass_batch(k_grid, T_stack, model_params=model_params, t0=t0)
+    return {tag: (float(t_i), float(s_i)) for tag, t_i, s_i in zip(tags, t, sigma_t)}
@@ -1,13 +1,17 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
-from scipy.ndimage import gaussian_filter1d
-from config import save_plots, P_k_max_h_Mpc
+from config import (save_plots, P_k_max_h_Mpc, class_path, class_profiles, k_max_ladder, k_resolve_T,
+                    k_suppression_samples)
+from instrument import stage
+from fastio import read_table
+from plots import save_plot_data
 
 def modify_psd(input_file, output_dir, T_ref=10.0):
     """Prepares a CLASS-compatible PSD file from sterile-dm output."""
-    raw_data = np.loadtxt(input_file, comments="#")[:, :2]
+    from scipy.interpolate import interp1d
+    from scipy.ndimage import gaussian_filter1d
+
+    raw_data = np.array(read_table(input_file, comments="#")[:, :2])
     raw_data[:, 0] /= T_ref  # Convert p to q = p / T
 
     raw_data = raw_data[~np.isnan(raw_data).any(axis=1)]
@@ -36,82 +40,151 @@ def modify_psd(input_file, output_dir, T_ref=10.0):
     np.savetxt(out_path, np.column_stack([q_vals, f_vals]), fmt="%13.7e  %13.7e")
 
     if save_plots:
-        plot_dir = os.path.join(output_dir, "../plots")
-        os.makedirs(plot_dir, exist_ok=True)
+        with stage("plot"):
+            save_plot_data(os.path.join(output_dir, "../plots"), "psd_plot", q=q_vals, f=f_vals)
 
-        plt.plot(q_vals, q_vals**2 * f_vals)
-        plt.xlabel("q = p/T")
-        plt.ylabel(r"$q^2 f(q)$")
-        plt.title("Modified and Smoothed PSD")
-        plt.savefig(os.path.join(plot_dir, "psd_plot.png"))
-        plt.close()
+    return out_path
 
+def class_parameters(psd_path, sterile_mass_keV, mixing_angle, profile="full", k_range=None):
+    """
+    Returns the CLASS input parameters for a sterile neutrino with a given PSD as a dict
+    of strings. Shared by the .ini writer and the in-process classy backend; PSD files
+    are referenced by absolute path. The precision profile's overrides (see
+    config.class_profiles) are applied last, then the point's k range (see k_range_for).
+    """
+    params = _base_class_parameters(psd_path, sterile_mass_keV, mixing_angle)
+    for key, value in {**class_profiles[profile], **(k_range or {})}.items():
+        if value is None:
+            params.pop(key, None)
+        else:
+            params[key] = value
+    return params
+
+def _model_scale(T_level):
+    """x = a k t^b at which the transfer-function fit model falls to T_level."""
+    from postprocess import v
+    return (T_level**(-v/5) - 1)**(1 / (2*v))
+
+def k_range_for(t):
+    """
+    CLASS k settings for a point with (expected) thermal mass t: the smallest rung of
+    k_max_ladder that reaches the scale where T(k) = k_resolve_T, and a k sampling that puts
+    k_suppression_samples nodes between T = 0.9 and that scale. The suppression has the
+    same width in log k for every t, so only P_k_max depends on the point.
+    """
+    from postprocess import a, b
+    k_needed = _model_scale(k_resolve_T) / (a * t**b)
+    k_max = next((k for k in sorted(k_max_ladder) if k >= k_needed), max(k_max_ladder))
+    width = np.log10(_model_scale(k_resolve_T) / _model_scale(0.9))
+    return {"P_k_max_h/Mpc": f"{k_max}", "k_per_decade_for_pk": f"{int(np.ceil(k_suppression_samples / width))}"}
+
+def _base_class_parameters(psd_path, sterile_mass_keV, mixing_angle):
+    class_psd_filename = os.path.abspath(psd_path)
+    fd_psd_filename = os.path.abspath(os.path.join(class_path, "psd_FD_single.dat"))
+
+    return {
+        "output": "tCl,pCl,lCl,mPk",
+        "evolver": "0",
+        "modes": "s",
+        "ic": "ad",
+        "gauge": "synchronous",
+
+        "h": "0.67360",
+        "T_cmb": "2.72548",
+        "omega_b": "0.022369232127999995",
+        "omega_cdm": "0.0",
+        "Omega_k": "0.",
+        "N_ur": "2.0308",
+        "N_ncdm": "2",
+        "use_ncdm_psd_files": "1,1",
+        "ncdm_psd_filenames": f"{fd_psd_filename},{class_psd_filename}",
+        "m_ncdm": f"0.06,{sterile_mass_keV * 1e3:.1f}",
+        "omega_ncdm": "0,0.12",
+        "T_ncdm": "0.71611,0.71611",
+        "ksi_ncdm": "0,0",
+        "deg_ncdm": "1.0,1.0",
+        "ncdm_quadrature_strategy": "0,0",
+        "ncdm_maximum_q": "12.,12.",
+        "ncdm_N_momentum_bins": "150,150",
+        "ncdm_fluid_approximation": "3,3",
+
+        "tol_ncdm": "1e-3",
+        "tol_ncdm_bg": "1e-3",
+
+        "recombination": "HyRec",
+        "YHe": "BBN",
+        "reio_parametrization": "reio_camb",
+        "z_reio": "7.6711",
+
+        "Pk_ini_type": "analytic_Pk",
+        "k_pivot": "0.05",
+        "A_s": "2.100549e-09",
+        "n_s": "0.9660499",
+        "alpha_s": "0.",
+        "l_max_scalars": "2500",
+        "P_k_max_h/Mpc": f"{P_k_max_h_Mpc}",
+        "z_pk": "0",
+        "lensing": "yes",
+    }
+
+# Per-species (comma-separated) ncdm parameters; the first entry is the standard neutrino
+NCDM_LIST_KEYS = ("use_ncdm_psd_files", "ncdm_psd_filenames", "m_ncdm", "omega_ncdm", "T_ncdm", "ksi_ncdm",
+                  "deg_ncdm", "ncdm_quadrature_strategy", "ncdm_maximum_q", "ncdm_N_momentum_bins",
+                  "ncdm_fluid_approximation")
+
+def lcdm_class_parameters(profile="full", k_range=None):
+    """
+    CLASS parameters of the LCDM reference matching class_parameters at the same profile
+    and k range: the same cosmology and precision, with the sterile ncdm species replaced
+    by CDM of the same density (the standard massive neutrino is kept).
+    """
+    fd_psd_filename = os.path.join(class_path, "psd_FD_single.dat")
+    params = class_parameters(fd_psd_filename, 1.0, 0.0, profile, k_range)
+    params["omega_cdm"] = params["omega_ncdm"].split(",")[1]
+    params["N_ncdm"] = "1"
+    for key in NCDM_LIST_KEYS:
+        if key in params:
+            params[key] = params[key].split(",")[0]
+    return params
+
+def write_class_ini(params, ini_path, root, title="CLASS input"):
+    """Writes a CLASS .ini from a parameter dict, with file output under the absolute `root` prefix."""
+    file_output = {
+        "overwrite_root": "no",
+        "headers": "yes",
+        "format": "class",
+        "write_background": "y",
+        "write_parameters": "yes",
+        "write_warnings": "no",
+        "input_verbose": "1",
+        "output_verbose": "1",
+        "root": root,
+    }
 
-    return out_path
+    with open(ini_path, "w") as f:
+        f.write(f"# {title}\n")
+        for key, value in params.items():
+            f.write(f"{key} = {value}\n")
+        f.write("\n")
+        for key, value in file_output.items():
+            f.write(f"{key} = {value}\n")
 
-def generate_class_ini(psd_path, sterile_mass_keV, mixing_angle, output_dir):
-    """Generates a CLASS .ini file for a sterile neutrino with a given PSD."""
+    return ini_path
+
+def generate_class_ini(psd_path, sterile_mass_keV, mixing_angle, output_dir, root_dir=None, profile="full",
+                       k_range=None):
+    """
+    Generates a CLASS .ini file for a sterile neutrino with a given PSD.
+    PSD files and the output root are written as absolute paths so CLASS can run
+    from any working directory. root_dir defaults to a private "output" folder
+    next to the .ini, so concurrent points never share CLASS outputs.
+    """
     os.makedirs(output_dir, exist_ok=True)
     ini_path = os.path.join(output_dir, "class.ini")
     root_tag = f"ms{sterile_mass_keV:.3e}_s2{mixing_angle:.3e}"
-    class_psd_filename = os.path.basename(psd_path)
-
-    with open(ini_path, "w") as f:
-        f.write(f"""# CLASS input for sterile neutrino
-output = tCl,pCl,lCl,mPk
-evolver = 0
-modes = s
-ic = ad
-gauge = synchronous
-
-h = 0.67360
-T_cmb = 2.72548
-omega_b = 0.022369232127999995
-omega_cdm = 0.0
-Omega_k = 0.
-N_ur = 2.0308
-N_ncdm = 2
-use_ncdm_psd_files = 1,1
-ncdm_psd_filenames = psd_FD_single.dat,{class_psd_filename}
-m_ncdm = 0.06,{sterile_mass_keV * 1e3:.1f}
-omega_ncdm = 0,0.12
-T_ncdm = 0.71611,0.71611
-ksi_ncdm = 0,0
-deg_ncdm = 1.0,1.0
-ncdm_quadrature_strategy = 0,0
-ncdm_maximum_q = 12.,12.
-ncdm_N_momentum_bins = 150,150
-ncdm_fluid_approximation = 3,3
-
-tol_ncdm = 1e-3
-tol_ncdm_bg = 1e-3
-
-recombination = HyRec
-YHe = BBN
-reio_parametrization = reio_camb
-z_reio = 7.6711
-
-Pk_ini_type = analytic_Pk
-k_pivot = 0.05
-A_s = 2.100549e-09
-n_s = 0.9660499
-alpha_s = 0.
-l_max_scalars = 2500
-P_k_max_h/Mpc = {P_k_max_h_Mpc}
-z_pk = 0
-lensing = yes
-
-overwrite_root = no
-headers = yes
-format = class
-write_background = y
-write_parameters = yes
-write_warnings = no
-
-input_verbose = 1
-output_verbose = 1
-
-root = output/{root_tag}_
-""")
+    if root_dir is None:
+        root_dir = os.path.join(output_dir, "output")
+    root_dir = os.path.abspath(root_dir)
 
-    return ini_path
+    params = class_parameters(psd_path, sterile_mass_keV, mixing_angle, profile, k_range)
+    return write_class_ini(params, ini_path, f"{root_dir}/{root_tag}_", "CLASS input for sterile neutrino")
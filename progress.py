@@ -0,0 +1,94 @@
+import os
+import time
+from collections import deque
+from datetime import datetime
+from config import base_output_dir
+from results_index import append_record
+
+EVENTS_LOG = "events.jsonl"
+RATE_WINDOW = 50  # completions used for the live throughput estimate
+
+def _duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}h{rest // 60:02d}m" if hours else f"{rest // 60}m{rest % 60:02d}s"
+
+class ProgressTracker:
+    """
+    Event-driven campaign progress. The scheduler (or a queue worker) pushes events as
+    they happen: point_started, stage_submitted (a stage handed to a process),
+    stage_finished, point_finished and point_failed, plus campaign_started/campaign_finished.
+    A started point is "running" while one of its stages is in a process and "queued" while
+    it waits for one (e.g. for a free CLASS slot or a retry). Counters are updated per event, every event is
+    appended to base_output_dir/events.jsonl, and listeners (callables taking the event
+    dict and the tracker) are called; the default listener prints a progress line with
+    throughput and ETA whenever a point ends.
+    """
+    def __init__(self, total=None, events_path=None, listeners=None):
+        self.total = total
+        self.events_path = events_path or os.path.join(base_output_dir, EVENTS_LOG)
+        self.listeners = [print_progress] if listeners is None else list(listeners)
+        self.started = self.done = self.failed = 0
+        self.in_stage = 0
+        self.start_time = time.monotonic()
+        self._completions = deque(maxlen=RATE_WINDOW)
+
+    @property
+    def running(self):
+        return self.in_stage
+
+    @property
+    def queued(self):
+        return max(self.started - self.done - self.failed - self.in_stage, 0)
+
+    def throughput(self):
+        """Points per second over the last RATE_WINDOW completions (whole run until then)."""
+        now = time.monotonic()
+        if len(self._completions) < 2:
+            finished = self.done + self.failed
+            return finished / (now - self.start_time) if finished else 0.0
+        return (len(self._completions) - 1) / max(self._completions[-1] - self._completions[0], 1e-9)
+
+    def eta(self):
+        """Seconds until all points are finished at the current throughput, or None."""
+        rate = self.throughput()
+        if self.total is None or rate <= 0:
+            return None
+        return max(self.total - self.done - self.failed, 0) / rate
+
+    def emit(self, event, tag=None, **fields):
+        if event == "point_started":
+            self.started += 1
+        elif event == "stage_submitted":
+            self.in_stage += 1
+        elif event == "stage_finished":
+            self.in_stage = max(self.in_stage - 1, 0)
+        elif event in ("point_finished", "point_failed"):
+            if event == "point_finished":
+                self.done += 1
+            else:
+                self.failed += 1
+            self._completions.append(time.monotonic())
+        record = {"event": event, "time": datetime.now().isoformat(timespec="milliseconds"), "pid": os.getpid()}
+        if tag is not None:
+            record["tag"] = tag
+        record.update(fields)
+        append_record(self.events_path, record)
+        for listener in self.listeners:
+            listener(record, self)
+
+def print_progress(event, tracker):
+    """Default listener: one progress line per finished or failed point, and a final line."""
+    if event["event"] == "campaign_finished":
+        print(f"Finished {tracker.done} points ({tracker.failed} failed) in {_duration(event['wall_s'])}.")
+        return
+    if event["event"] not in ("point_finished", "point_failed"):
+        return
+    total = f"/{tracker.total}" if tracker.total is not None else ""
+    line = (f"Progress: {tracker.done}{total} completed | {tracker.running} running"
+            f" | {tracker.queued} queued | {tracker.failed} failed"
+            f" | {tracker.throughput() * 60:.1f} points/min")
+    eta = tracker.eta()
+    if eta is not None:
+        line += f" | ETA {_duration(eta)}"
+    print(line)
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+from collections import deque
+from config import base_output_dir, class_backend, omp_threads, default_stage_memory_mb, memory_headroom, footprint_margin
+from results_index import TIMINGS_INDEX, read_records
+
+# Instrumented stage (see instrument.stage) that holds each scheduler stage's external run
+STAGE_TIMINGS = {"sterile": "sterile_dm", "class": "class"}
+FOOTPRINT_SAMPLES = 50  # recent runs per stage used for its footprint
+MIN_CORES = 0.1  # smallest CPU share reserved for a run, even if it mostly waits
+CGROUP_ROOT = "/sys/fs/cgroup"
+UNLIMITED = 1 << 60  # cgroup v1 reports "no limit" as a huge number
+
+def external_run(stage, stages):
+    """
+    Timing record of a scheduler stage's external run among a point's stage timings
+    ({name: record}), or None if it did not run: skipped as done, or restored from the
+    artifact cache (no child process). Only in-process CLASS (classy) runs without a child.
+    """
+    timing = stages.get(STAGE_TIMINGS[stage])
+    if not timing or timing.get("wall_s", 0) <= 0:
+        return None
+    if timing.get("child_peak_rss_kb", 0) <= 0 and not (stage == "class" and class_backend == "classy"):
+        return None
+    return timing
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cgroup_files(name, v1_controller):
+    """Candidate paths of a cgroup control file for this process: its own cgroup first, then the root."""
+    paths = []
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            paths.append(os.path.join(CGROUP_ROOT, path.lstrip("/"), name))
+        elif v1_controller in controllers.split(","):
+            paths.append(os.path.join(CGROUP_ROOT, controllers, path.lstrip("/"), name))
+    paths += [os.path.join(CGROUP_ROOT, name), os.path.join(CGROUP_ROOT, v1_controller, name)]
+    return paths
+
+def _cgroup_value(name, v1_controller):
+    for path in _cgroup_files(name, v1_controller):
+        value = _read(path)
+        if value is not None:
+            return value
+    return None
+
+def cgroup_cpu_quota():
+    """CPUs allowed by a cgroup CPU quota (v2 cpu.max or v1 cfs quota/period), or None without one."""
+    cpu_max = _cgroup_value("cpu.max", "cpu")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max":
+            return int(quota) / int(period or 100000)
+        return None
+    quota, period = _cgroup_value("cpu.cfs_quota_us", "cpu"), _cgroup_value("cpu.cfs_period_us", "cpu")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+def cpu_limit():
+    """CPUs this process may use: its CPU affinity, further limited by any cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    return max(min(cpus, quota) if quota else cpus, 1.0)
+
+def memory_available_mb():
+    """
+    Memory that new processes can use: MemAvailable, further limited by the room left
+    under a cgroup memory limit (v2 memory.max or v1 memory.limit_in_bytes).
+    """
+    available = None
+    for line in (_read("/proc/meminfo") or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            available = int(line.split()[1]) * 1024
+    limit = _cgroup_value("memory.max", "memory") or _cgroup_value("memory.limit_in_bytes", "memory")
+    usage = _cgroup_value("memory.current", "memory") or _cgroup_value("memory.usage_in_bytes", "memory")
+    if limit and limit != "max" and int(limit) < UNLIMITED:
+        room = int(limit) - int(usage or 0)
+        available = room if available is None else min(available, room)
+    if available is None:
+        available = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return available / 2**20
+
+class FootprintModel:
+    """
+    Typical footprint of one run of each scheduler stage: peak RSS (MB) and CPU cores
+    actually used (CPU time / wall time), learned from the timings index, which also holds
+    earlier campaigns. Until a stage has runs, default_stage_memory_mb and omp_threads apply.
+    """
+    def __init__(self, results_dir=base_output_dir):
+        self.index_path = os.path.join(results_dir, TIMINGS_INDEX)
+        self.offset = 0
+        self.samples = {stage: deque(maxlen=FOOTPRINT_SAMPLES) for stage in STAGE_TIMINGS}
+        self.update()
+
+    def update(self):
+        """Reads the runs appended to the timings index since the last call."""
+        records, self.offset = read_records(self.index_path, self.offset)
+        for record in records:
+            for stage in STAGE_TIMINGS:
+                timing = external_run(stage, record.get("stages", {}))
+                if timing is None:
+                    continue
+                # External runs report the child; in-process CLASS (classy) is the worker itself
+                rss_kb = timing.get("child_peak_rss_kb") or timing.get("self_peak_rss_kb", 0)
+                cores = (timing.get("cpu_s", 0) + timing.get("child_cpu_s", 0)) / timing["wall_s"]
+                self.samples[stage].append((rss_kb / 1024, cores))
+
+    def footprint(self, stage):
+        """(memory_mb, cores) to reserve for one run: 90th percentiles of recent runs, or the defaults."""
+        if not self.samples[stage]:
+            return float(default_stage_memory_mb[stage]), float(omp_threads[stage])
+        memory, cores = np.percentile(np.array(self.samples[stage]), 90, axis=0)
+        return float(memory) * footprint_margin, max(float(cores), MIN_CORES)
+
+class AdmissionControl:
+    """
+    Admits a new stage process only while the footprints of the running ones plus its own
+    fit in the CPU limit (affinity and cgroup quota) and in memory_headroom of the memory
+    available when the campaign started. One job is always admitted, so a stage larger
+    than the node still runs (alone).
+    """
+    def __init__(self, footprints=None, cpus=None, memory_mb=None):
+        self.footprints = footprints or FootprintModel()
+        self.cpus = cpus or cpu_limit()
+        self.memory_mb = memory_mb or memory_available_mb() * memory_headroom
+        self._running = {}
+
+    def used(self):
+        """(memory_mb, cores) reserved by running jobs."""
+        running = self._running.values()
+        return sum(m for m, _ in running), sum(c for _, c in running)
+
+    def fits(self, stage):
+        if not self._running:
+            return True
+        memory, cores = self.footprints.footprint(stage)
+        used_memory, used_cores = self.used()
+        return used_memory + memory <= self.memory_mb and used_cores + cores <= self.cpus + 1e-9
+
+    def start(self, job, stage):
+        self._running[job] = self.footprints.footprint(stage)
+
+    def finish(self, job):
+        self._running.pop(job, None)
+        self.footprints.update()
@@ -0,0 +1,55 @@
+import os
+import json
+import fcntl
+from datetime import datetime
+
+RESULTS_INDEX = "results_index.jsonl"
+TIMINGS_INDEX = "timings_index.jsonl"
+
+def append_record(index_path, record):
+    """
+    Appends one JSON record as a single line to an append-only index.
+    An exclusive flock keeps lines from concurrent workers (and nodes with
+    lock-aware shared filesystems) from interleaving.
+    """
+    line = json.dumps(record) + "\n"
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    with open(index_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def read_records(index_path, offset=0):
+    """
+    Reads the complete records appended after byte offset.
+    Returns (records, new_offset); a partially written last line is left for the next read.
+    """
+    if not os.path.exists(index_path):
+        return [], offset
+    with open(index_path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    records = []
+    for line in data[:end].splitlines():
+        if line.strip():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records, offset + end
+
+def append_result(output_dir, result):
+    """Records a finished grid point (its results.json contents) in the results index of its campaign."""
+    record = dict(result)
+    record["tag"] = os.path.basename(os.path.normpath(output_dir))
+    record["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    append_record(os.path.join(os.path.dirname(os.path.normpath(output_dir)), RESULTS_INDEX), record)
+
+def append_timings(output_dir, stages):
+    """Records the stage timings of one pipeline step of a grid point in the timings index."""
+    record = {"tag": os.path.basename(os.path.normpath(output_dir)), "stages": stages}
+    append_record(os.path.join(os.path.dirname(os.path.normpath(output_dir)), TIMINGS_INDEX), record)
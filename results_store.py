@@ -0,0 +1,108 @@
+import numpy as np
+from checkpoint import atomic_output
+
+# Typed columns of the campaign store; stage timings are added as "wall_<stage>" and
+# "<metric>_<stage>" columns (one per TIMING_METRICS entry)
+FLOAT_COLUMNS = ("mass_keV", "mixing_angle", "lepton_asymmetry", "thermal_mass", "dm_density", "fit_nfev")
+STRING_COLUMNS = ("tag", "status", "timestamp", "class_profile")
+TIMING_METRICS = ("wall_s", "cpu_s", "child_cpu_s", "child_peak_rss_kb", "io_read_bytes", "io_write_bytes",
+                  "child_io_read_bytes", "child_io_write_bytes")
+
+def _as_float(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return np.nan
+
+def entry_status(entry):
+    """Status of a result entry: its recorded status, SKIPPED for overproduced points, else OK."""
+    if entry.get("status"):
+        return entry["status"]
+    if entry.get("thermal_mass") == "SKIPPED":
+        return "SKIPPED"
+    return "OK"
+
+def timing_column(stage, metric):
+    """Store column holding one timing metric of a stage."""
+    return f"wall_{stage}" if metric == "wall_s" else f"{metric}_{stage}"
+
+def timed_stages(columns):
+    """Stages with timing columns in the store."""
+    return sorted(name[len("wall_"):] for name in columns if name.startswith("wall_"))
+
+def _grow(values, size, string):
+    grown = np.full(size, "" if string else np.nan, dtype=object if string else float)
+    grown[:len(values)] = values
+    return grown
+
+def merge_columns(columns, entries=(), point_timings=None):
+    """
+    Merges result entries (as in all_results.json) and per-point stage timings
+    ({tag: {stage: record}}) into store columns ({} for a new store), one row per tag.
+    A tag's new entry or stage timing replaces its previous one; new tags are appended.
+    Non-numeric values (e.g. thermal_mass "SKIPPED") become NaN, and tags with timings
+    but no result entry yet have an empty status.
+    """
+    point_timings = point_timings or {}
+    tags = list(columns.get("tag", ()))
+    rows = {tag: i for i, tag in enumerate(tags)}
+    for tag in [e["tag"] for e in entries] + list(point_timings):
+        if tag not in rows:
+            rows[tag] = len(tags)
+            tags.append(tag)
+    names = dict.fromkeys(FLOAT_COLUMNS + STRING_COLUMNS + tuple(columns))
+    merged = {name: _grow(columns.get(name, ()), len(tags), name in STRING_COLUMNS) for name in names}
+    merged["tag"][:] = tags
+
+    for e in entries:
+        row = rows[e["tag"]]
+        for name in FLOAT_COLUMNS:
+            merged[name][row] = _as_float(e.get(name))
+        merged["status"][row] = entry_status(e)
+        merged["timestamp"][row] = e.get("timestamp", "")
+        merged["class_profile"][row] = e.get("class_profile", "")
+    for tag, stages in point_timings.items():
+        for stage, record in stages.items():
+            for metric in TIMING_METRICS:
+                name = timing_column(stage, metric)
+                if name not in merged:
+                    merged[name] = _grow((), len(tags), False)
+                merged[name][rows[tag]] = record.get(metric, 0)
+    return {name: values.astype(str) if name in STRING_COLUMNS else values for name, values in merged.items()}
+
+def build_columns(entries, point_timings=None):
+    """Typed columns of a new store holding these entries and timings (see merge_columns)."""
+    return merge_columns({}, entries, point_timings)
+
+def save_store(path, columns):
+    """Writes the columns to an .npz store atomically (readers never see a partial file)."""
+    with atomic_output(path) as tmp_path:
+        # Written through a file object, so np.savez does not append ".npz" to the temporary name
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **columns)
+
+def load_results(path="all_results.npz", **ranges):
+    """
+    Loads the campaign store as {column: array}, optionally filtered (see query).
+    Example: load_results(thermal_mass=(5, 6), status="OK")
+    """
+    with np.load(path) as data:
+        columns = {name: data[name] for name in data.files}
+    return query(columns, **ranges) if ranges else columns
+
+def query(columns, **ranges):
+    """
+    Filters store columns row-wise. Each keyword is a column name with either a
+    (low, high) inclusive range (None for an open end) or a value to match exactly.
+    """
+    mask = np.ones(len(columns["tag"]), dtype=bool)
+    for name, condition in ranges.items():
+        values = columns[name]
+        if isinstance(condition, tuple):
+            low, high = condition
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+        else:
+            mask &= values == condition
+    return {name: values[mask] for name, values in columns.items()}
@@ -1,65 +1,152 @@
 import os
+import glob
 import shutil
 import subprocess
+import json
+import numpy as np
 from config import class_path
+from instrument import wait_child
+from artifact_cache import file_digest, input_key
+from checkpoint import atomic_output, commit_file
 
 CLASS_WORKDIR = class_path
 CLASS_EXECUTABLE = "./class"
 
-def extract_psd_path_from_ini(ini_path):
-    """Returns the full path to the Snapshot100_modified.dat referenced in the .ini file."""
+# One classy.Class instance per worker process, reused across grid points
+_classy_instance = None
+
+def extract_root_from_ini(ini_path):
+    """Returns the absolute output root (CLASS `root = ...`) referenced in the .ini file."""
     with open(ini_path, "r") as f:
         for line in f:
-            if "Snapshot100_modified.dat" in line:
-                return os.path.join(os.path.dirname(ini_path), "Snapshot100_modified.dat")
-    raise FileNotFoundError("Could not find PSD filename in .ini file.")
+            key, sep, value = line.partition("=")
+            if sep and key.strip() == "root":
+                root = value.strip()
+                if not os.path.isabs(root):
+                    root = os.path.join(CLASS_WORKDIR, root)
+                return root
+    raise ValueError(f"Could not find output root in {ini_path}.")
 
-def run_class(ini_file, output_dir, class_exec):
+def run_class(ini_file, output_dir, class_exec=CLASS_EXECUTABLE):
     """
-    Runs CLASS from its working directory.
-    Copies PSD and .ini file into CLASS_WORKDIR, runs CLASS, then moves the output pk.dat back to output_dir.
+    Runs CLASS on ini_file inside a private scratch workspace.
+    The .ini references its PSD files by absolute path and writes to its own `root`,
+    so nothing is copied into or deleted from the shared CLASS_WORKDIR and any number
+    of points can run concurrently. The resulting *_pk.dat is moved to output_dir/pk.dat
+    in one rename. Errors (CalledProcessError on a failed run) are raised to the caller.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    psd_path = extract_psd_path_from_ini(ini_file)
-    psd_basename = "Snapshot100_modified.dat"
-    ini_basename = "class.ini"
+    root = extract_root_from_ini(ini_file)
+    workspace = os.path.dirname(root)
+    class_binary = os.path.abspath(os.path.join(CLASS_WORKDIR, class_exec))
 
-    psd_target = os.path.join(CLASS_WORKDIR, psd_basename)
-    ini_target = os.path.join(CLASS_WORKDIR, ini_basename)
+    try:
+        # === Step 0: Clean this point's scratch workspace ===
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        os.makedirs(workspace)
 
-    class_output_dir = os.path.join(CLASS_WORKDIR, "output")
+        # === Step 1: Run CLASS ===
+        args = [class_binary, os.path.abspath(ini_file)]
+        proc = subprocess.Popen(args, cwd=CLASS_WORKDIR)
+        if wait_child(proc) != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)
 
-    try:
-        # === Step 0: Clean existing CLASS output directory ===
-        if os.path.exists(class_output_dir):
-            for f in os.listdir(class_output_dir):
-                os.remove(os.path.join(class_output_dir, f))
-
-        # === Step 1: Copy inputs ===
-        shutil.copy(psd_path, psd_target)
-        shutil.copy(ini_file, ini_target)
-
-        # === Step 2: Run CLASS ===
-        subprocess.run([CLASS_EXECUTABLE, ini_basename], cwd=CLASS_WORKDIR, check=True)
-
-        # === Step 3: Find and move *_pk.dat to pipeline output ===
-        found_pk = False
-        for fname in os.listdir(class_output_dir):
-            if fname.endswith("_pk.dat"):
-                shutil.move(os.path.join(class_output_dir, fname), os.path.join(output_dir, "pk.dat"))
-                found_pk = True
-                break
-
-        if not found_pk:
+        # === Step 2: Move this point's *_pk.dat to pipeline output ===
+        candidates = sorted(glob.glob(glob.escape(root) + "*pk.dat"))
+        if not candidates:
             raise FileNotFoundError("CLASS run completed but pk.dat not found in output.")
+        commit_file(candidates[0], os.path.join(output_dir, "pk.dat"), move=True)
+
+    finally:
+        # === Step 3: Remove scratch workspace ===
+        shutil.rmtree(workspace, ignore_errors=True)
+
 
-    except subprocess.CalledProcessError as e:
-        print(f"CLASS run failed for {ini_file}: {e}")
-    except Exception as err:
-        print(f"Unexpected error running CLASS: {err}")
+def _get_classy():
+    """Returns this process's cached classy.Class instance (raises ImportError without classy)."""
+    global _classy_instance
+    if _classy_instance is None:
+        from classy import Class
+        _classy_instance = Class()
+    return _classy_instance
+
+def run_class_classy(params, output_dir=None):
+    """
+    Runs CLASS in-process through its Python wrapper (classy) with a parameter dict
+    (see prepare_class_input.class_parameters). Returns the z=0 linear power spectrum
+    as arrays (k [h/Mpc], P(k) [(Mpc/h)^3]) on CLASS's own k nodes, i.e. the same
+    columns CLASS writes to *_pk.dat. If output_dir is given the spectrum is also
+    saved to output_dir/pk.npy so the stage can be skipped on rerun.
+    """
+    cosmo = _get_classy()
+    cosmo.set(params)
+    try:
+        cosmo.compute()
+        h = cosmo.h()
+        pk, k, z = cosmo.get_pk_and_k_and_z(nonlinear=False)
+        iz = int(np.argmin(np.abs(z)))
+        k_h = np.asarray(k) / h
+        P_h = np.asarray(pk)[:, iz] * h**3
     finally:
-        # === Step 4: Cleanup copied files ===
-        for temp_file in [psd_target, ini_target]:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+        cosmo.struct_cleanup()
+        cosmo.empty()
+
+    order = np.argsort(k_h)
+    k_h, P_h = k_h[order], P_h[order]
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        with atomic_output(os.path.join(output_dir, "pk.npy")) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.column_stack([k_h, P_h]))
+
+    return k_h, P_h
+
+def classy_cosmology(params):
+    """
+    A new classy.Class computed with a parameter dict, for callers that keep it to evaluate
+    P(k) repeatedly (see classy_pk). Raises ImportError without classy.
+    """
+    from classy import Class
+    cosmo = Class()
+    cosmo.set(params)
+    cosmo.compute()
+    return cosmo
+
+def classy_pk(cosmo, k_h):
+    """
+    Linear z=0 P(k) [(Mpc/h)^3] of a computed classy cosmology at k [h/Mpc]; NaN outside its k range.
+    Only classy's own error for a k it cannot evaluate (CosmoSevereError) is turned into NaN.
+    """
+    from classy import CosmoSevereError
+    h = cosmo.h()
+    P_h = np.full(len(k_h), np.nan)
+    for i, k in enumerate(np.asarray(k_h, dtype=float)):
+        try:
+            P_h[i] = cosmo.pk_lin(k * h, 0.0) * h**3
+        except CosmoSevereError:
+            continue
+    return P_h
+
+def classy_available():
+    try:
+        import classy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def class_input_key(params, psd_paths, backend, class_exec=CLASS_EXECUTABLE):
+    """
+    Cache key of a CLASS run: the CLASS parameters (PSD file names replaced by the
+    digests of psd_paths), the backend and the CLASS build (binary digest or classy version).
+    """
+    params = {key: value for key, value in params.items() if key != "ncdm_psd_filenames"}
+    if backend == "classy":
+        import classy
+        build = f"classy {getattr(classy, '__version__', '')}"
+    else:
+        build = file_digest(os.path.join(CLASS_WORKDIR, class_exec))
+    return input_key("class", json.dumps(params, sort_keys=True), backend, build,
+                     *[file_digest(path) for path in psd_paths])
@@ -1,8 +1,19 @@
-import subprocess, shutil, time, os, glob, re
+import subprocess, shutil, os, glob, re, time, queue, threading, json
 from math import isclose
+from config import sterile_dm_isolated, overproduction_threshold
+from instrument import wait_child
+from artifact_cache import file_digest, input_key, fetch, store
+from checkpoint import commit_file
+
+OMEGA_PATTERN = re.compile(r"Omega_wdm h\^2=\s+([\d.Ee+-]+)")
+STERILE_DM_TIMEOUT = 1800  # seconds
+POLL_INTERVAL = 1.0  # seconds between state.dat checks
+
 class OverproductionError(Exception):
     """Raised when sterile-dm overproduces sterile neutrino density."""
-    pass
+    def __init__(self, omega):
+        self.omega = omega
+        super().__init__(f"Omega_wdm h^2 = {omega:.2e} (overproduction)")
 
 
 def parse_outfile_dirname(name):
@@ -15,57 +26,27 @@ def parse_outfile_dirname(name):
             raise ValueError(f"Failed to parse float from dirname: {name}") from e
     return None, None
 
-def run_sterile_dm(mass, theta, output_dir, exe_path):
-    os.makedirs(os.path.join(output_dir, "sterile_dm"), exist_ok=True)
-
-    orig_params = os.path.join(exe_path, "params.ini")
-    backup_params = os.path.join(exe_path, "params_backup.ini")
-    temp_params = os.path.join(output_dir, "sterile_dm", "params.ini")
-    temp_params_abs = os.path.abspath(temp_params)
-
-    if not os.path.exists(backup_params):
-        shutil.copy(orig_params, backup_params)
-
-    mass_MeV = mass / 1e3
-    with open(backup_params, "r") as f:
-        lines = f.readlines()
-
-    with open(temp_params, "w", newline="\n") as f:
-        for line in lines:
-            if line.strip().startswith("ms ="):
-                f.write(f"ms = {mass_MeV:.6E}\n")
-            elif line.strip().startswith("s2 ="):
-                f.write(f"s2 = {theta:.6E}\n")
-            else:
-                f.write(line)
-
-    # Allow process to finish even if exit code ≠ 0
-    result = subprocess.run(
-        ["./sterile-nu", temp_params_abs],
-        cwd=exe_path,
-        capture_output=True,
-        text=True,
-        check=False,
-        timeout=1800
-    )
-    time.sleep(1)
-
-    stdout = result.stdout + result.stderr
-    match = re.search(r"Omega_wdm h\^2=\s+([\d.Ee+-]+)", stdout)
-    if match:
-        omega = float(match.group(1))
-        if omega > 0.125:
-            raise OverproductionError(f"Omega_wdm h^2 = {omega:.2e} (overproduction)")
-
-    # If not overproduced, but sterile-dm failed, raise error
-    if result.returncode != 0:
-        raise subprocess.CalledProcessError(result.returncode, result.args, output=result.stdout, stderr=result.stderr)
+def prepare_sterile_workdir(exe_path, work_dir):
+    """
+    Builds a private sterile-dm working directory: every entry of the install is
+    symlinked in, except params files and outfiles/, which get a fresh empty folder.
+    sterile-dm then writes its output folder where no other run can see it.
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(os.path.join(work_dir, "outfiles"))
+    for name in os.listdir(exe_path):
+        if name in ("outfiles", "params.ini", "params_backup.ini"):
+            continue
+        os.symlink(os.path.abspath(os.path.join(exe_path, name)), os.path.join(work_dir, name))
+    return work_dir
 
+def find_shared_output(exe_path, mass_MeV, theta):
+    """Locates a run's folder in the shared sterile-dm outfiles/ by mass/mixing tolerance."""
     candidates = glob.glob(os.path.join(exe_path, "outfiles", "ms*s2*L*"))
     if not candidates:
         raise RuntimeError("sterile-dm completed but no output folder found.")
 
-    actual_output = None
     for path in candidates:
         dirname = os.path.basename(path)
         ms_val, s2_val = parse_outfile_dirname(dirname)
@@ -76,13 +57,215 @@ def run_sterile_dm(mass, theta, output_dir, exe_path):
         mixing_tol = 0.01
 
         if abs(ms_val - mass_MeV) <= mass_tol and abs(s2_val - theta) / theta <= mixing_tol:
-            actual_output = path
-            break
+            return path
+
+    raise FileNotFoundError(f"No matching output: mass={mass_MeV * 1e3:.3f} keV, s2={theta:.2e}")
+
+def find_private_output(work_dir):
+    """Returns the single output folder sterile-dm wrote into a private work directory."""
+    outfiles = os.path.join(work_dir, "outfiles")
+    entries = [e for e in os.listdir(outfiles) if os.path.isdir(os.path.join(outfiles, e))]
+    if not entries:
+        raise RuntimeError("sterile-dm completed but no output folder found.")
+    if len(entries) > 1:
+        raise RuntimeError(f"Expected one sterile-dm output folder in {outfiles}, found {len(entries)}.")
+    return os.path.join(outfiles, entries[0])
+
+class StateTail:
+    """
+    Incrementally reads the DM density (5th column) from a growing state.dat.
+    Only complete lines are parsed; the file is located lazily because sterile-dm
+    creates its output folder after start-up.
+    """
+    def __init__(self, locate):
+        self.locate = locate
+        self.path = None
+        self.offset = 0
+        self.buffer = ""
+        self.omega = None
+
+    def poll(self):
+        if self.path is None:
+            self.path = self.locate()
+            if self.path is None:
+                return self.omega
+        try:
+            with open(self.path, "r") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return self.omega
+        lines = (self.buffer + chunk).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            values = line.split()
+            if len(values) >= 5 and not line.startswith("!"):
+                try:
+                    self.omega = float(values[4])
+                except ValueError:
+                    pass
+        return self.omega
+
+def _private_state_file(work_dir):
+    """Returns the state.dat path in a private work dir once sterile-dm has created it."""
+    matches = glob.glob(os.path.join(work_dir, "outfiles", "*", "state.dat"))
+    return matches[0] if len(matches) == 1 else None
+
+def _read_lines(pipe, sink):
+    for line in pipe:
+        sink.put(line)
+    sink.put(None)
+
+def stream_sterile_dm(args, work_dir, state_file=None, threshold=overproduction_threshold,
+                      timeout=STERILE_DM_TIMEOUT, poll_interval=POLL_INTERVAL):
+    """
+    Runs sterile-dm with Popen, watching its output while it runs.
+    Stdout/stderr are scanned for "Omega_wdm h^2=" and, if state_file is given
+    (a callable returning the state.dat path or None), the running DM density is
+    tailed from state.dat. The relic abundance only grows during production, so the
+    process is killed and OverproductionError raised as soon as either exceeds threshold.
+    Returns (returncode, combined output).
+    """
+    proc = subprocess.Popen(args, cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    lines = queue.Queue()
+    reader = threading.Thread(target=_read_lines, args=(proc.stdout, lines), daemon=True)
+    reader.start()
+    tail = StateTail(state_file) if state_file else None
+    deadline = time.monotonic() + timeout
+    output = []
+    eof = False
+
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=poll_interval)
+                while True:
+                    if line is None:
+                        eof = True
+                        break
+                    output.append(line)
+                    match = OMEGA_PATTERN.search(line)
+                    if match and float(match.group(1)) > threshold:
+                        raise OverproductionError(float(match.group(1)))
+                    line = lines.get_nowait()
+            except queue.Empty:
+                pass
+
+            if tail is not None:
+                omega = tail.poll()
+                if omega is not None and omega > threshold:
+                    raise OverproductionError(omega)
+
+            if eof:
+                return wait_child(proc), "".join(output)
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(args, timeout, output="".join(output))
+    except BaseException:
+        proc.kill()
+        wait_child(proc)
+        raise
+    finally:
+        reader.join(timeout=1.0)
+        proc.stdout.close()
+
+def sterile_params_text(mass, theta, exe_path):
+    """
+    Returns the params.ini contents for a point: the install's template
+    (params_backup.ini if present, else params.ini) with ms and s2 replaced.
+    """
+    backup_params = os.path.join(exe_path, "params_backup.ini")
+    template_params = backup_params if os.path.exists(backup_params) else os.path.join(exe_path, "params.ini")
+
+    mass_MeV = mass / 1e3
+    with open(template_params, "r") as f:
+        lines = f.readlines()
+
+    out = []
+    for line in lines:
+        if line.strip().startswith("ms ="):
+            out.append(f"ms = {mass_MeV:.6E}\n")
+        elif line.strip().startswith("s2 ="):
+            out.append(f"s2 = {theta:.6E}\n")
+        else:
+            out.append(line)
+    return "".join(out)
+
+def sterile_input_key(params_text, exe_path):
+    """Cache key of a sterile-dm run: its params.ini contents and the sterile-nu binary."""
+    return input_key("sterile", params_text, file_digest(os.path.join(exe_path, "sterile-nu")))
+
+def run_sterile_dm(mass, theta, output_dir, exe_path, isolated=sterile_dm_isolated, use_cache=True):
+    """
+    Runs sterile-dm for one (mass, mixing) point and copies Snapshot100.dat and state.dat
+    into output_dir/sterile_dm. Raises OverproductionError as soon as the running DM
+    density exceeds overproduction_threshold (the run is killed).
+    With isolated=True each run gets its own working directory (output_dir/sterile_dm/work),
+    so concurrent runs never share params or outfiles.
+    Outcomes are stored in the artifact cache under a hash of params.ini and the sterile-nu
+    binary and reused when use_cache is set. An aborted run only shows that Omega h^2 exceeded
+    the threshold it ran with, so overproduction is cached per overproduction_threshold.
+    Returns the input key of the run.
+    """
+    sterile_dir = os.path.join(output_dir, "sterile_dm")
+    os.makedirs(sterile_dir, exist_ok=True)
+
+    orig_params = os.path.join(exe_path, "params.ini")
+    backup_params = os.path.join(exe_path, "params_backup.ini")
+    temp_params = os.path.join(sterile_dir, "params.ini")
+    temp_params_abs = os.path.abspath(temp_params)
+
+    if not isolated and not os.path.exists(backup_params):
+        shutil.copy(orig_params, backup_params)
+
+    mass_MeV = mass / 1e3
+    params_text = sterile_params_text(mass, theta, exe_path)
+    with open(temp_params, "w", newline="\n") as f:
+        f.write(params_text)
+
+    key = sterile_input_key(params_text, exe_path)
+    aborted_key = input_key("sterile_aborted", key, overproduction_threshold)
+    if use_cache:
+        if fetch("sterile", key, sterile_dir) is not None:
+            return key
+        if fetch("sterile_aborted", aborted_key, sterile_dir) is not None:
+            with open(os.path.join(sterile_dir, "overproduced.json")) as f:
+                omega = json.load(f)["omega"]
+            if omega > overproduction_threshold:
+                raise OverproductionError(omega)
+
+    if isolated:
+        # Read-only use of the install: never write a shared backup from parallel workers
+        work_dir = prepare_sterile_workdir(exe_path, os.path.abspath(os.path.join(sterile_dir, "work")))
+    else:
+        work_dir = exe_path
+
+    # Stream output and abort as soon as the DM density crosses the overproduction threshold.
+    # Allow process to finish even if exit code ≠ 0
+    args = ["./sterile-nu", temp_params_abs]
+    state_file = (lambda: _private_state_file(work_dir)) if isolated else None
+    try:
+        try:
+            returncode, output = stream_sterile_dm(args, work_dir, state_file=state_file)
+        except OverproductionError as e:
+            store("sterile_aborted", aborted_key, {"overproduced.json": json.dumps({"omega": e.omega}).encode()})
+            raise
+
+        # If not overproduced, but sterile-dm failed, raise error
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args, output=output)
+
+        if isolated:
+            actual_output = find_private_output(work_dir)
+        else:
+            actual_output = find_shared_output(exe_path, mass_MeV, theta)
 
-    if actual_output is None:
-        raise FileNotFoundError(f"No matching output: mass={mass:.3f} keV, s2={theta:.2e}")
+        for file in ["Snapshot100.dat", "state.dat"]:
+            commit_file(os.path.join(actual_output, file), os.path.join(sterile_dir, file))
+    finally:
+        # The private working directory goes whatever the outcome (abort, error exit, missing output)
+        if isolated:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-    for file in ["Snapshot100.dat", "state.dat"]:
-        src = os.path.join(actual_output, file)
-        dst = os.path.join(output_dir, "sterile_dm", file)
-        shutil.copy(src, dst)
+    store("sterile", key, [os.path.join(sterile_dir, "Snapshot100.dat"), os.path.join(sterile_dir, "state.dat")])
+    return key
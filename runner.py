@@ -1,39 +1,189 @@
 import os
 import json
-from config import mass_grid, theta_grid, sterile_dm_path, class_path, lcdm_reference_path, base_output_dir
-from run_production import run_sterile_dm, OverproductionError  # 🔁
-from prepare_class_input import modify_psd, generate_class_ini
-from run_class import run_class
-from postprocess import extract_transfer_function, fit_thermal_mass
-from utils import extract_lepton_number, write_summary, extract_final_dm_density
-
-def should_skip_step(output_dir, step):
+from config import (mass_grid, theta_grid, sterile_dm_path, class_path, lcdm_reference_path, base_output_dir, class_backend,
+                    overproduction_threshold, class_profile, class_screening_profile, class_full_window, auto_k_range,
+                    k_max_ladder)
+from run_production import run_sterile_dm, OverproductionError, sterile_params_text, sterile_input_key  # 🔁
+from prepare_class_input import modify_psd, generate_class_ini, class_parameters, k_range_for
+from run_class import run_class, run_class_classy, class_input_key, classy_available
+import postprocess
+from postprocess import (extract_transfer_function, fit_thermal_mass, save_transfer_function, neighbour_fit_start,
+                         expected_thermal_mass)
+from utils import extract_lepton_number, write_summary, extract_final_dm_density, point_tag, read_results
+from instrument import begin_point, end_point, stage
+from artifact_cache import fetch, store, input_key, file_digest
+from checkpoint import stage_entry, read_manifest, mark_stage, clear_stage, known_failure, run_checkpointed, write_json
+from lcdm_reference import ensure_lcdm_reference, lcdm_reference_key, classy_reference
+
+def should_skip_step(output_dir, step, key=None):
+    """
+    True if the point's manifest marks the step done and its outputs exist in output_dir.
+    A sterile step still overproduced at the current threshold counts as done (the point
+    ends there); one that no longer is counts as done only if sterile-dm ran to the end.
+    When the step's input key is given, the outputs must also have been produced from
+    exactly those inputs.
+    """
+    entry = stage_entry(output_dir, step)
+    if entry is None or entry["status"] not in ("done", "overproduced"):
+        return False
+    if key is not None and entry.get("input_key") != key:
+        return False
+    if overproduced(entry):
+        return step == "sterile" and os.path.exists(os.path.join(output_dir, "results.json"))
+    if entry["status"] == "overproduced" and not entry.get("complete"):
+        return False  # the aborted run's Omega h^2 was only a lower bound
     if step == "sterile":
         return os.path.exists(os.path.join(output_dir, "sterile_dm", "Snapshot100.dat"))
     elif step == "class":
-        return os.path.exists(os.path.join(output_dir, "class_output", "pk.dat"))
+        return find_power_spectrum(output_dir) is not None
     elif step == "postprocess":
         return os.path.exists(os.path.join(output_dir, "results.json"))
     return False
 
-def run_pipeline_for_point(mass_keV, theta):
-    tag = f"m_{mass_keV:.1e}_theta_{theta:.1e}"
+def overproduced(entry):
+    """True if a sterile manifest entry marks the point overproduced at the current threshold."""
+    return (entry is not None and entry["status"] == "overproduced"
+            and entry.get("omega", float("inf")) > overproduction_threshold)
+
+def sterile_passed(output_dir):
+    """True if the point's manifest lets it go on to CLASS: sterile-dm finished and is not overproduced."""
+    entry = stage_entry(output_dir, "sterile")
+    if entry is None or overproduced(entry):
+        return False
+    return entry["status"] == "done" or (entry["status"] == "overproduced" and bool(entry.get("complete")))
+
+def point_done(output_dir):
+    """True if the point's manifest shows it finished: postprocessed, or overproduced at the current threshold."""
+    stages = read_manifest(output_dir)["stages"]
+    if overproduced(stages.get("sterile")):
+        return True
+    return all((stages.get(step) or {}).get("status") == "done" for step in ("class", "postprocess"))
+
+def _invalidate_results(output_dir):
+    """Forgets results.json (and its postprocess entry) before a step it derives from runs on new inputs."""
+    path = os.path.join(output_dir, "results.json")
+    if os.path.exists(path):
+        os.remove(path)
+    clear_stage(output_dir, "postprocess")
+
+def effective_class_backend():
+    """The CLASS backend that will actually run (classy falls back to the executable)."""
+    if class_backend == "classy" and classy_available():
+        return "classy"
+    return "executable"
+
+def class_step_key(sterile_psd, mass_keV, theta, profile=class_profile, k_range=None):
+    """
+    Input key of the CLASS step: the CLASS parameters (incl. the precision profile and k range),
+    the raw sterile-dm PSD (which fully determines the modified PSD for a given CODE_VERSION),
+    the Fermi-Dirac PSD and the CLASS build.
+    """
+    params = class_parameters(sterile_psd, mass_keV, theta, profile, k_range)
+    fd_psd = os.path.join(class_path, "psd_FD_single.dat")
+    psd_paths = [sterile_psd] + ([fd_psd] if os.path.exists(fd_psd) else [])
+    return class_input_key(params, psd_paths, effective_class_backend())
+
+def postprocess_step_key(class_key, lcdm_key):
+    """Input key of postprocessing: the CLASS key, the LCDM reference and the fit model parameters."""
+    return input_key("postprocess", class_key, lcdm_key, postprocess.a, postprocess.b, postprocess.v)
+
+def reference_key(profile=class_profile, k_range=None):
+    """Key of the LCDM reference used for CLASS runs at this profile and k range."""
+    if lcdm_reference_path == "auto":
+        return lcdm_reference_key(profile, k_range, effective_class_backend())
+    return file_digest(lcdm_reference_path)
+
+def reference_spectrum(profile=class_profile, k_range=None):
+    """
+    The LCDM reference: generated with matching CLASS settings (a P(k) function with classy,
+    see lcdm_reference.classy_reference, else a path), or lcdm_reference_path.
+    """
+    if lcdm_reference_path == "auto":
+        with stage("lcdm_reference"):
+            backend = effective_class_backend()
+            if backend == "classy":
+                return classy_reference(profile, k_range)
+            return ensure_lcdm_reference(profile, k_range, backend)
+    return lcdm_reference_path
+
+def _clear_power_spectra(class_output_dir):
+    for name in ("pk.dat", "pk.npy"):
+        path = os.path.join(class_output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def find_power_spectrum(output_dir):
+    """Returns the saved CLASS power spectrum for a point (pk.dat or classy's pk.npy), or None."""
+    for name in ("pk.dat", "pk.npy"):
+        path = os.path.join(output_dir, "class_output", name)
+        if os.path.exists(path):
+            return path
+    return None
+
+def run_class_stage(modified_psd, mass_keV, theta, class_input_dir, class_output_dir, profile=class_profile,
+                    k_range=None):
+    """
+    Runs CLASS with the configured backend and precision profile. Returns (k, P) arrays
+    when CLASS ran in-process via classy, or None when the executable wrote class_output/pk.dat.
+    """
+    if class_backend == "classy":
+        try:
+            params = class_parameters(modified_psd, mass_keV, theta, profile, k_range)
+            return run_class_classy(params, class_output_dir)
+        except ImportError:
+            print("classy is not installed; falling back to the CLASS executable.")
+    ini_path = generate_class_ini(modified_psd, mass_keV, theta, class_input_dir, profile=profile, k_range=k_range)
+    run_class(ini_path, class_output_dir, class_exec="./class")
+    return None
+
+def run_sterile_step(mass_keV, theta):
+    """
+    Stage 1 of a grid point: sterile-dm and the overproduction check.
+    Returns True if the point should go on to CLASS.
+    """
+    tag = point_tag(mass_keV, theta)
     base_dir = os.path.join(base_output_dir, tag)
     os.makedirs(base_dir, exist_ok=True)
+    begin_point(base_dir)
+    try:
+        return _sterile_step(mass_keV, theta, tag, base_dir)
+    finally:
+        end_point()
 
+def _sterile_step(mass_keV, theta, tag, base_dir):
     # === 1. Sterile-DM ===
-    if not should_skip_step(base_dir, "sterile"):
+    try:
+        sterile_key = sterile_input_key(sterile_params_text(mass_keV, theta, sterile_dm_path), sterile_dm_path)
+    except OSError as e:
+        print(f"[{tag}] Error in sterile-dm: {e}")
+        log_error(base_dir, "sterile", e)
+        return False
+
+    entry = stage_entry(base_dir, "sterile")
+    if should_skip_step(base_dir, "sterile", sterile_key) and overproduced(entry):
+        print(f"[{tag}] Skipping sterile-dm: overproduced.")
+        return False
+    failure = known_failure(base_dir, "sterile", sterile_key)
+    if failure:
+        print(f"[{tag}] Skipping sterile-dm: failed on the same inputs before ({failure['error']}).")
+        return False
+
+    if not should_skip_step(base_dir, "sterile", sterile_key):
         try:
             print(f"[{tag}] Running sterile-dm...")
-            run_sterile_dm(mass_keV, theta, base_dir, sterile_dm_path)
+            with stage("sterile_dm"):
+                run_checkpointed(base_dir, "sterile", sterile_key,
+                                 lambda: run_sterile_dm(mass_keV, theta, base_dir, sterile_dm_path),
+                                 passthrough=(OverproductionError,))
         except OverproductionError as e:  # 🔁
             print(f"[{tag}] Overproduction detected during sterile-dm: {e}")  # 🔁
-            write_summary(base_dir, mass_keV, theta, L=None, t=None, omega_dm=float(str(e).split("=")[-1].split()[0]), status="OVERPRODUCED")  # 🔁
-            return  # 🔁
+            write_summary(base_dir, mass_keV, theta, None, None, e.omega, status="OVERPRODUCED")  # 🔁
+            mark_stage(base_dir, "sterile", "overproduced", sterile_key, omega=e.omega, complete=False)
+            return False  # 🔁
         except Exception as e:
             print(f"[{tag}] Error in sterile-dm: {e}")
             log_error(base_dir, "sterile", e)
-            return
+            return False
     else:
         print(f"[{tag}] Skipping sterile-dm.")
 
@@ -42,49 +192,182 @@ def run_pipeline_for_point(mass_keV, theta):
     try:
         L = extract_lepton_number(state_path)
         omega_dm = extract_final_dm_density(state_path)
-        if omega_dm > 0.125:
-            print(f"[{tag}] Overproduction detected (Ω h^2 = {omega_dm:.5f} > 0.125). Skipping CLASS and postprocessing.")
+        if omega_dm > overproduction_threshold:
+            print(f"[{tag}] Overproduction detected (Ω h^2 = {omega_dm:.5f} > {overproduction_threshold}). Skipping CLASS and postprocessing.")
             write_summary(base_dir, mass_keV, theta, L, "SKIPPED", omega_dm)
-            return
+            mark_stage(base_dir, "sterile", "overproduced", sterile_key, omega=omega_dm, complete=True)
+            clear_stage(base_dir, "postprocess")  # results.json now holds the SKIPPED summary
+            return False
     except Exception as e:
         print(f"[{tag}] Error while checking DM density: {e}")
         log_error(base_dir, "sterile", e)
+        return False
+
+    return True
+
+def run_class_step(mass_keV, theta):
+    """Stage 2 of a grid point: CLASS and postprocessing. Requires a completed sterile step."""
+    tag = point_tag(mass_keV, theta)
+    base_dir = os.path.join(base_output_dir, tag)
+    begin_point(base_dir)
+    try:
+        _class_step(mass_keV, theta, tag, base_dir)
+    finally:
+        end_point()
+
+def point_k_range(base_dir, mass_keV, theta):
+    """
+    The CLASS k settings of a point with auto_k_range (None without): the saved choice in
+    class_input/k_range.json, else one chosen from the neighbours' thermal masses or, without
+    neighbours, from the sterile mass. Saving the choice keeps the CLASS key stable on reruns.
+    """
+    if not auto_k_range:
+        return None
+    path = os.path.join(base_dir, "class_input", "k_range.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    t_guess, _ = neighbour_fit_start(mass_keV, theta, base_output_dir)
+    k_range = k_range_for(t_guess or expected_thermal_mass(mass_keV))
+    save_k_range(base_dir, k_range)
+    return k_range
+
+def save_k_range(base_dir, k_range):
+    os.makedirs(os.path.join(base_dir, "class_input"), exist_ok=True)
+    write_json(os.path.join(base_dir, "class_input", "k_range.json"), k_range)
+
+def _class_step(mass_keV, theta, tag, base_dir):
+    """
+    Runs CLASS and postprocessing at class_profile. With a screening profile configured,
+    the point is first run at that profile and rerun at class_profile only if its coarse
+    thermal mass lies in class_full_window.
+    """
+    sterile_psd = os.path.join(base_dir, "sterile_dm", "Snapshot100.dat")
+    profile = class_screening_profile or class_profile
+    k_range = point_k_range(base_dir, mass_keV, theta)
+    # A point already upgraded to the final profile goes straight to it (and is skipped)
+    if (stage_entry(base_dir, "class") or {}).get("input_key") == class_step_key(sterile_psd, mass_keV, theta, class_profile, k_range):
+        profile = class_profile
+
+    t_fit = _resolved_class_run(mass_keV, theta, tag, base_dir, profile)
+    if profile == class_profile or t_fit is None:
         return
+    if class_full_window[0] <= t_fit <= class_full_window[1]:
+        print(f"[{tag}] Coarse t = {t_fit:.3g} keV is in the full-precision window; rerunning CLASS ({class_profile}).")
+        _resolved_class_run(mass_keV, theta, tag, base_dir, class_profile, t_guess=t_fit)
+
+def _resolved_class_run(mass_keV, theta, tag, base_dir, profile, t_guess=None):
+    """
+    CLASS and postprocessing at one profile. With auto_k_range, the run is repeated with a
+    higher P_k_max when the fitted t shows the suppression was not resolved.
+    Returns the fitted t, or None.
+    """
+    k_range = point_k_range(base_dir, mass_keV, theta)
+    while True:
+        t_fit = _class_and_postprocess(mass_keV, theta, tag, base_dir, profile, t_guess, k_range)
+        if k_range is None or t_fit is None:
+            return t_fit
+        needed = k_range_for(t_fit)
+        if float(needed["P_k_max_h/Mpc"]) <= float(k_range["P_k_max_h/Mpc"]):
+            return t_fit
+        if float(k_range["P_k_max_h/Mpc"]) >= max(k_max_ladder):
+            print(f"[{tag}] Warning: suppression of t = {t_fit:.3g} keV is not resolved at the largest k_max.")
+            return t_fit
+        print(f"[{tag}] Suppression not resolved at P_k_max = {k_range['P_k_max_h/Mpc']} h/Mpc; "
+              f"rerunning CLASS up to {needed['P_k_max_h/Mpc']} h/Mpc.")
+        k_range, t_guess = needed, t_fit
+        save_k_range(base_dir, k_range)
+
+def _class_and_postprocess(mass_keV, theta, tag, base_dir, profile, t_guess=None, k_range=None):
+    """
+    CLASS at one precision profile and the thermal-mass fit, each checkpointed in the
+    point's manifest (see checkpoint.run_checkpointed). Returns the fitted t, or None.
+    """
+    sterile_psd = os.path.join(base_dir, "sterile_dm", "Snapshot100.dat")
+    class_output_dir = os.path.join(base_dir, "class_output")
 
     # === 3. CLASS ===
-    if not should_skip_step(base_dir, "class"):
-        try:
-            print(f"[{tag}] Preparing and running CLASS...")
-            sterile_psd = os.path.join(base_dir, "sterile_dm", "Snapshot100.dat")
-            class_input_dir = os.path.join(base_dir, "class_input")
-            class_output_dir = os.path.join(base_dir, "class_output")
-
-            modified_psd = modify_psd(sterile_psd, class_input_dir)
-            ini_path = generate_class_ini(modified_psd, mass_keV, theta, class_input_dir)
-            run_class(ini_path, class_output_dir, class_exec="./class")
-        except Exception as e:
-            print(f"[{tag}] Error in CLASS: {e}")
-            log_error(base_dir, "class", e)
-            return
-    else:
-        print(f"[{tag}] Skipping CLASS.")
+    spectrum = None
+    try:
+        class_key = class_step_key(sterile_psd, mass_keV, theta, profile, k_range)
+        failure = known_failure(base_dir, "class", class_key)
+        if should_skip_step(base_dir, "class", class_key):
+            print(f"[{tag}] Skipping CLASS ({profile}).")
+        elif failure:
+            print(f"[{tag}] Skipping CLASS ({profile}): failed on the same inputs before ({failure['error']}).")
+            return None
+        else:
+            _invalidate_results(base_dir)
+            _clear_power_spectra(class_output_dir)
+            if fetch("class", class_key, class_output_dir) is not None:
+                print(f"[{tag}] Reusing cached CLASS output ({profile}).")
+                mark_stage(base_dir, "class", "done", class_key)
+            else:
+                print(f"[{tag}] Preparing and running CLASS ({profile})...")
+                spectrum = run_checkpointed(base_dir, "class", class_key,
+                                            lambda: _run_class(mass_keV, theta, base_dir, profile, k_range))
+                store("class", class_key, [find_power_spectrum(base_dir)])
+    except Exception as e:
+        print(f"[{tag}] Error in CLASS: {e}")
+        log_error(base_dir, "class", e)
+        return None
 
     # === 4. Postprocess ===
-    if not should_skip_step(base_dir, "postprocess"):
-        try:
-            print(f"[{tag}] Postprocessing results...")
-            pk_path = os.path.join(base_dir, "class_output", "pk.dat")
-            k, T = extract_transfer_function(pk_path, lcdm_reference_path)
-            t_fit = fit_thermal_mass(k, T, output_dir=base_dir)
+    post_key = postprocess_step_key(class_key, reference_key(profile, k_range))
+    if should_skip_step(base_dir, "postprocess", post_key):
+        print(f"[{tag}] Skipping postprocessing.")
+        t_fit = (read_results(base_dir) or {}).get("thermal_mass")
+        return t_fit if isinstance(t_fit, (int, float)) else None
+    failure = known_failure(base_dir, "postprocess", post_key)
+    if failure:
+        print(f"[{tag}] Skipping postprocessing: failed on the same inputs before ({failure['error']}).")
+        return None
+    _invalidate_results(base_dir)
+    try:
+        print(f"[{tag}] Postprocessing results...")
+        return run_checkpointed(base_dir, "postprocess", post_key,
+                                lambda: _postprocess(mass_keV, theta, base_dir, spectrum, profile, t_guess, k_range))
+    except Exception as e:
+        print(f"[{tag}] Error in postprocessing: {e}")
+        log_error(base_dir, "postprocess", e)
+        return None
 
-            L = extract_lepton_number(state_path)
-            write_summary(base_dir, mass_keV, theta, L, t_fit, omega_dm)
+def _run_class(mass_keV, theta, base_dir, profile, k_range):
+    """Prepares the PSD and runs CLASS. Returns the in-memory spectrum from classy, or None."""
+    class_input_dir = os.path.join(base_dir, "class_input")
+    with stage("modify_psd"):
+        modified_psd = modify_psd(os.path.join(base_dir, "sterile_dm", "Snapshot100.dat"), class_input_dir)
+    with stage("class"):
+        spectrum = run_class_stage(modified_psd, mass_keV, theta, class_input_dir,
+                                   os.path.join(base_dir, "class_output"), profile, k_range)
+    if find_power_spectrum(base_dir) is None:
+        raise FileNotFoundError("CLASS finished without writing a power spectrum.")
+    return spectrum
 
-        except Exception as e:
-            print(f"[{tag}] Error in postprocessing: {e}")
-            log_error(base_dir, "postprocess", e)
-    else:
-        print(f"[{tag}] Skipping postprocessing.")
+def _postprocess(mass_keV, theta, base_dir, spectrum, profile, t_guess, k_range):
+    """Transfer function, thermal-mass fit and results.json. Returns the fitted t."""
+    state_path = os.path.join(base_dir, "sterile_dm", "state.dat")
+    pk_source = spectrum if spectrum is not None else find_power_spectrum(base_dir)
+    if pk_source is None:
+        raise FileNotFoundError("No CLASS power spectrum found in class_output.")
+    lcdm_path = reference_spectrum(profile, k_range)
+    with stage("transfer_function"):
+        k, T = extract_transfer_function(pk_source, lcdm_path)
+        save_transfer_function(base_dir, k, T)
+    with stage("fit_thermal_mass"):
+        p0, bounds = neighbour_fit_start(mass_keV, theta, base_output_dir)
+        t_fit, fit_info = fit_thermal_mass(k, T, output_dir=base_dir, p0=t_guess or p0, bounds=bounds,
+                                           return_info=True)
+
+    with stage("summary"):
+        L = extract_lepton_number(state_path)
+        omega_dm = extract_final_dm_density(state_path)
+        write_summary(base_dir, mass_keV, theta, L, t_fit, omega_dm, fit_info=fit_info, class_profile=profile)
+    return t_fit
+
+def run_pipeline_for_point(mass_keV, theta):
+    if run_sterile_step(mass_keV, theta):
+        run_class_step(mass_keV, theta)
 
 def log_error(base_dir, step, exception):
     log_path = os.path.join(base_dir, "error.log")
@@ -100,7 +383,7 @@ def main():
             try:
                 run_pipeline_for_point(mass, theta)
             except Exception as e:
-                tag = f"m_{mass:.1e}_theta_{theta:.1e}"
+                tag = point_tag(mass, theta)
                 print(f"[{tag}] ❌ Error: {e}")
                 err_dir = os.path.join(base_output_dir, tag)
                 os.makedirs(err_dir, exist_ok=True)
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import heapq
+import itertools
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+from config import (base_output_dir, max_concurrency, stage_concurrency, omp_threads, stage_max_attempts,
+                    stage_retry_backoff)
+from runner import run_sterile_step, run_class_step, sterile_passed, point_done
+from instrument import last_stages
+from checkpoint import transient_failure
+from results_index import append_record
+from utils import point_tag
+from progress import ProgressTracker
+from resources import AdmissionControl, cpu_limit, external_run
+
+STAGES = ("sterile", "class")
+# Checkpointed steps (see checkpoint.run_checkpointed) of each stage
+CHECKPOINT_STAGES = {"sterile": ("sterile",), "class": ("class", "postprocess")}
+DEFAULT_RUNTIME = 60.0  # seconds, used before any timings have been recorded
+
+class RuntimeModel:
+    """
+    Per-stage runtime model fitted on recorded timings: least squares of
+    log(seconds) on (log mass, log theta), falling back to the mean with few samples.
+    Timings are appended to a JSONL history file so the model improves across campaigns.
+    """
+    def __init__(self, history_path=os.path.join(base_output_dir, "runtime_history.jsonl")):
+        self.history_path = history_path
+        self.samples = {stage: [] for stage in STAGES}
+        self._fits = {}
+        if os.path.exists(history_path):
+            with open(history_path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.samples[rec["stage"]].append((rec["mass_keV"], rec["mixing_angle"], rec["seconds"]))
+                    except (ValueError, KeyError):
+                        continue
+
+    def record(self, stage, mass, theta, seconds):
+        self.samples[stage].append((mass, theta, seconds))
+        self._fits.pop(stage, None)
+        # Locked like the results indexes: queue workers on several nodes share this file
+        append_record(self.history_path, {"stage": stage, "mass_keV": mass, "mixing_angle": theta, "seconds": seconds})
+
+    def _fit(self, stage):
+        if stage not in self._fits:
+            data = np.array([s for s in self.samples[stage] if s[2] > 0], dtype=float).reshape(-1, 3)
+            if len(data) >= 4:
+                A = np.column_stack([np.ones(len(data)), np.log(data[:, 0]), np.log(data[:, 1])])
+                coef, *_ = np.linalg.lstsq(A, np.log(data[:, 2]), rcond=None)
+                self._fits[stage] = ("linear", coef)
+            elif len(data):
+                self._fits[stage] = ("mean", np.log(data[:, 2]).mean())
+            else:
+                self._fits[stage] = ("default", np.log(DEFAULT_RUNTIME))
+        return self._fits[stage]
+
+    def predict(self, stage, mass, theta):
+        """Predicted wall time in seconds of one stage for a point."""
+        kind, coef = self._fit(stage)
+        if kind == "linear":
+            return float(np.exp(coef[0] + coef[1] * np.log(mass) + coef[2] * np.log(theta)))
+        return float(np.exp(coef))
+
+# Modules imported once by the forkserver so each worker starts from a preloaded template.
+# Workers still re-run the entry script, but its imports are then already loaded.
+# Heavy dependencies (scipy) stay lazy and load only in workers that run the CLASS stage.
+WORKER_PRELOAD = ["main"]
+
+def worker_context():
+    """Multiprocessing context for pool workers: forkserver with preloaded modules where available."""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    # The forkserver does not inherit sys.path, so make the pipeline modules importable for it
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    python_path = os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    if repo_dir not in python_path:
+        os.environ["PYTHONPATH"] = os.pathsep.join([repo_dir] + [p for p in python_path if p])
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(WORKER_PRELOAD)
+    return ctx
+
+def record_failure(base_dir, exception):
+    os.makedirs(base_dir, exist_ok=True)
+    with open(os.path.join(base_dir, "error.log"), "a") as log:
+        log.write(str(exception) + "\n")
+    with open(os.path.join(base_dir, ".fail"), "w") as f:
+        f.write("FAILED\n")
+
+def run_stage(stage, mass, theta):
+    """
+    Worker entry point for one stage of one point; the processes it starts get
+    OMP_NUM_THREADS from omp_threads.
+    Returns (ok, seconds, ran): ok means the point's manifest shows it succeeded so far
+    (sterile: go on to CLASS, class: postprocessed), ran is False when the stage's program did not run (skipped
+    as already done or restored from the artifact cache), so the time is no runtime sample.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(omp_threads[stage])
+    base_dir = os.path.join(base_output_dir, point_tag(mass, theta))
+    start = time.perf_counter()
+    try:
+        if stage == "sterile":
+            ok = run_sterile_step(mass, theta) and sterile_passed(base_dir)
+        else:
+            run_class_step(mass, theta)
+            ok = point_done(base_dir)
+    except Exception as e:
+        record_failure(base_dir, e)
+        ok = False
+    return ok, time.perf_counter() - start, external_run(stage, last_stages()) is not None
+
+def now_iso():
+    return datetime.now().isoformat(timespec="seconds")
+
+def retry_delay(stage, mass, theta, since, retries):
+    """
+    Seconds to wait before rerunning a stage of a point whose run started at `since` (see
+    now_iso) ended in a transient failure, or None if it did not or stage_max_attempts runs
+    were used up (retries: reruns already made). The caller queues the rerun, so no worker
+    or reservation is held during the backoff.
+    """
+    if retries + 1 >= stage_max_attempts:
+        return None
+    tag = point_tag(mass, theta)
+    entry = transient_failure(os.path.join(base_output_dir, tag), CHECKPOINT_STAGES[stage], since)
+    if entry is None:
+        return None
+    delay = stage_retry_backoff * 2**retries
+    print(f"[{tag}] Transient error in {stage} ({entry.get('error')}); retrying in {delay:g}s.")
+    return delay
+
+class Scheduler:
+    """
+    Runs grid points as two pipelined stages (sterile-dm, then CLASS + postprocessing)
+    with separate process pools and per-stage concurrency caps. Ready jobs are dispatched
+    longest-predicted-first (see RuntimeModel), so slow points start early instead of
+    forming a tail, and CLASS for one point overlaps sterile-dm for others. A job is only
+    started when its learned CPU and memory footprint fits what is left (see resources).
+    A job that fails transiently is queued again after its backoff (see retry_delay).
+    """
+    def __init__(self, max_workers=max_concurrency, stage_workers=stage_concurrency, runtime_model=None,
+                 admission=None):
+        self.max_workers = max_workers or int(cpu_limit())
+        self.stage_workers = {stage: min((stage_workers or {}).get(stage) or self.max_workers, self.max_workers)
+                              for stage in STAGES}
+        self.model = runtime_model or RuntimeModel()
+        self.admission = admission or AdmissionControl()
+        self._seq = itertools.count()
+
+    def _push(self, ready, stage, point, tier=0):
+        """Queues a ready job; lower tiers go first, then longer predicted runtimes."""
+        cost = self.model.predict(stage, *point)
+        heapq.heappush(ready[stage], (tier, -cost, next(self._seq), point))
+
+    def _next_job(self, ready, running_per_stage):
+        """Pops the most expensive ready job among stages that have free slots and fit the free resources."""
+        best = None
+        for stage in STAGES:
+            if (ready[stage] and running_per_stage[stage] < self.stage_workers[stage]
+                    and self.admission.fits(stage)):
+                if best is None or ready[stage][0] < ready[best][0]:
+                    best = stage
+        if best is None:
+            return None
+        return best, heapq.heappop(ready[best])[-1]
+
+    def run(self, points, progress=None, tiers=None):
+        """
+        Runs every (mass_keV, theta) point through both stages. Returns {tag: status}.
+        tiers maps (mass_keV, theta) to a priority tier (default 0); a point in a higher tier
+        is only dispatched when no lower-tier job of the same stage is ready.
+        Progress events are pushed to `progress` (a ProgressTracker, one is created if None)
+        as futures complete; the loop blocks on completions (or the next due retry) and never polls.
+        """
+        progress = progress or ProgressTracker(len(points))
+        status = {point_tag(m, t): "pending" for m, t in points}
+        tiers = tiers or {}
+        ready = {stage: [] for stage in STAGES}
+        for point in points:
+            self._push(ready, "sterile", point, tiers.get(tuple(point), 0))
+        running = {}
+        running_per_stage = {stage: 0 for stage in STAGES}
+        delayed = []  # (due, seq, stage, point) of transient failures waiting for their backoff
+        retries = {}
+        progress.emit("campaign_started", total=len(points))
+        print(f"Admission control: {self.admission.cpus:g} CPUs, {self.admission.memory_mb:.0f} MB for stage processes.")
+
+        ctx = worker_context()
+        pools = {stage: ProcessPoolExecutor(max_workers=self.stage_workers[stage], mp_context=ctx)
+                 for stage in STAGES}
+        try:
+            while running or any(ready.values()) or delayed:
+                while delayed and delayed[0][0] <= time.monotonic():
+                    _, _, stage, point = heapq.heappop(delayed)
+                    self._push(ready, stage, point, tiers.get(tuple(point), 0))
+                while len(running) < self.max_workers:
+                    job = self._next_job(ready, running_per_stage)
+                    if job is None:
+                        break
+                    stage, point = job
+                    future = pools[stage].submit(run_stage, stage, *point)
+                    self.admission.start(future, stage)
+                    running[future] = (stage, point, now_iso())
+                    running_per_stage[stage] += 1
+                    status[point_tag(*point)] = f"running {stage}"
+                    if stage == "sterile" and ("sterile", point_tag(*point)) not in retries:
+                        progress.emit("point_started", point_tag(*point), mass_keV=point[0], mixing_angle=point[1])
+                    progress.emit("stage_submitted", point_tag(*point), stage=stage)
+
+                timeout = max(delayed[0][0] - time.monotonic(), 0) if delayed else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, point, started = running.pop(future)
+                    running_per_stage[stage] -= 1
+                    self.admission.finish(future)
+                    tag = point_tag(*point)
+                    try:
+                        ok, seconds, ran = future.result()
+                    except Exception as e:
+                        record_failure(os.path.join(base_output_dir, tag), e)
+                        ok, seconds, ran = False, 0.0, False
+                    if ran:
+                        self.model.record(stage, point[0], point[1], seconds)
+                    progress.emit("stage_finished", tag, stage=stage, ok=ok, seconds=seconds, skipped=not ran)
+                    if not ok:
+                        delay = retry_delay(stage, *point, started, retries.get((stage, tag), 0))
+                        if delay is not None:
+                            retries[(stage, tag)] = retries.get((stage, tag), 0) + 1
+                            heapq.heappush(delayed, (time.monotonic() + delay, next(self._seq), stage, point))
+                            status[tag] = f"retrying {stage}"
+                            continue
+                    if stage == "sterile" and ok:
+                        self._push(ready, "class", point, tiers.get(tuple(point), 0))
+                        status[tag] = "pending class"
+                        continue
+                    # A sterile step can end the point without error (overproduction)
+                    status[tag] = "done" if ok or point_done(os.path.join(base_output_dir, tag)) else "error"
+                    progress.emit("point_finished" if status[tag] == "done" else "point_failed", tag)
+            progress.emit("campaign_finished", done=progress.done, failed=progress.failed,
+                          wall_s=time.monotonic() - progress.start_time)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+
+        return status
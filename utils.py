@@ -1,5 +1,25 @@
 import os
 import json
+from results_index import append_result
+from fastio import read_last_data_line
+from checkpoint import write_json
+
+def _tag_number(value):
+    """Short form if it identifies the value exactly, otherwise enough digits to keep values apart."""
+    short = f"{value:.1e}"
+    return short if float(short) == value else f"{value:.6e}"
+
+def point_tag(mass_keV, theta):
+    """Output folder name for a grid point (e.g. 44.0 -> 4.4e+01, 44.3 -> 4.430000e+01)."""
+    return f"m_{_tag_number(mass_keV)}_theta_{_tag_number(theta)}"
+
+def read_results(output_dir):
+    """Returns the parsed results.json of a grid point folder, or None if it has not finished."""
+    path = os.path.join(output_dir, "results.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
 
 def extract_lepton_number(state_path):
     """
@@ -18,7 +38,8 @@ def extract_lepton_number(state_path):
     raise ValueError("No valid data lines found in state.dat.")
 
 
-def write_summary(output_dir, mass_keV, mixing_angle, lepton_number, thermal_mass, dm_density):
+def write_summary(output_dir, mass_keV, mixing_angle, lepton_number, thermal_mass, dm_density, status=None, fit_info=None,
+                  class_profile=None):
     result = {
         "mass_keV": mass_keV,
         "mixing_angle": mixing_angle,
@@ -26,10 +47,17 @@ def write_summary(output_dir, mass_keV, mixing_angle, lepton_number, thermal_mas
         "thermal_mass": thermal_mass if thermal_mass is not None else "SKIPPED",
         "dm_density": dm_density
     }
-
-    summary_path = os.path.join(output_dir, "results.json")
-    with open(summary_path, "w") as f:
-        json.dump(result, f, indent=4)
+    if status is not None:
+        result["status"] = status
+    if class_profile is not None:
+        result["class_profile"] = class_profile
+    if fit_info is not None:
+        result["fit_nfev"] = fit_info["nfev"]
+        result["fit_p0"] = fit_info["p0"]
+        result["fit_p0_source"] = fit_info["p0_source"]
+
+    write_json(os.path.join(output_dir, "results.json"), result, indent=4)
+    append_result(output_dir, result)
 
     make_summary_page(output_dir, result)
 
@@ -48,7 +76,10 @@ def make_summary_page(output_dir, result):
         # Basic parameters
         f.write(f"<p><b>Mass (keV):</b> {result['mass_keV']:.2e}</p>\n")
         f.write(f"<p><b>Mixing Angle:</b> {result['mixing_angle']:.1e}</p>\n")
-        f.write(f"<p><b>Lepton Asymmetry:</b> {result['lepton_asymmetry']:.2e}</p>\n")
+        if result['lepton_asymmetry'] is None:
+            f.write("<p><b>Lepton Asymmetry:</b> <i>N/A</i></p>\n")
+        else:
+            f.write(f"<p><b>Lepton Asymmetry:</b> {result['lepton_asymmetry']:.2e}</p>\n")
         f.write(f"<p><b>DM Density:</b> {result['dm_density']:.3f}</p>\n")
 
         # Thermal mass (optional)
@@ -59,23 +90,23 @@ def make_summary_page(output_dir, result):
 
         # Plots
         f.write("<h3>Plots</h3>\n")
-        if os.path.exists(os.path.join(plots_dir, "psd_plot.png")):
-            f.write("<img src='plots/psd_plot.png' width='400'>\n")
-        if os.path.exists(os.path.join(plots_dir, "transfer_fit.png")):
-            f.write("<img src='plots/transfer_fit.png' width='400'>\n")
+        # PNGs are rendered later in batch (plots.py); link any plot whose data exists
+        for name in ("psd_plot", "transfer_fit"):
+            if any(os.path.exists(os.path.join(plots_dir, name + ext)) for ext in (".png", ".npz")):
+                f.write(f"<img src='plots/{name}.png' width='400' loading='lazy'>\n")
 
         f.write("</body></html>\n")
 
 
 def extract_final_dm_density(state_path):
     """
-    Extracts final Omega_wdm h^2 value from last data line of state.dat.
+    Extracts final Omega_wdm h^2 value from last data line of state.dat,
+    reading backwards from the end of the file.
     """
-    with open(state_path, "r") as f:
-        lines = [line for line in f if line.strip() and not line.startswith("!")]
-    if not lines:
+    line = read_last_data_line(state_path, comment="!")
+    if line is None:
         raise ValueError("No data lines found in state.dat.")
-    values = lines[-1].split()
+    values = line.split()
     if len(values) >= 5:
         return float(values[4])  # Final DM density is 5th column
     raise ValueError("Final line has fewer than 5 columns.")
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import socket
+import threading
+from config import base_output_dir, queue_heartbeat, queue_stale_after, queue_max_attempts
+from utils import point_tag
+from checkpoint import write_json
+
+# Shared-filesystem work queue. A ticket is one small JSON file that moves between
+# state folders with os.rename, which is atomic on a single filesystem (including NFS):
+#   pending/<rank>_<tag>.json           waiting; claimed in file-name order (longest first)
+#   claimed/<rank>_<tag>@<worker>.json  owned by a worker, which touches it as a heartbeat
+#   done/, failed/                      finished tickets
+# Claims whose heartbeat is older than queue_stale_after are moved back to pending.
+QUEUE_STATES = ("pending", "claimed", "done", "failed")
+POLL_INTERVAL = 5.0
+STAMP_FORMAT = "%Y%m%d%H%M%S"  # ticket names start with this stamp; pending tickets are due from then on
+
+def queue_dir(results_dir=base_output_dir):
+    return os.path.join(results_dir, "queue")
+
+def ensure_queue(qdir):
+    """Creates the queue's state folders, so workers may start before the first --enqueue."""
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(qdir, state), exist_ok=True)
+    return qdir
+
+def worker_id():
+    """Unique name of this worker process across nodes."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def _ticket_tag(name):
+    """Point tag of a ticket file name in any state."""
+    return os.path.splitext(name)[0].split("_", 1)[1].split("@", 1)[0]
+
+def _write_ticket(path, ticket):
+    write_json(path, ticket)
+
+def queued_tags(qdir):
+    """Tags of all tickets in the queue, per state."""
+    tags = {}
+    for state in QUEUE_STATES:
+        folder = os.path.join(qdir, state)
+        names = os.listdir(folder) if os.path.isdir(folder) else []
+        tags[state] = {_ticket_tag(n) for n in names if n.endswith(".json")}
+    return tags
+
+def enqueue(points, runtime_model=None, retry_failed=False, qdir=None, tiers=None):
+    """
+    Adds (mass_keV, theta) points to the queue, skipping points that already have a ticket.
+    Tickets are ranked by priority tier (see emulator.screen_points), then by predicted
+    runtime (see scheduler.RuntimeModel), so workers claim the slowest points first.
+    Returns the number of new tickets.
+    """
+    qdir = ensure_queue(qdir or queue_dir())
+    existing = queued_tags(qdir)
+    if retry_failed:
+        for name in os.listdir(os.path.join(qdir, "failed")):
+            if name.endswith(".json"):
+                os.rename(os.path.join(qdir, "failed", name), os.path.join(qdir, "pending", name))
+        existing["pending"] |= existing.pop("failed")
+    known = set().union(*existing.values())
+
+    tiers = tiers or {}
+    new_points = [p for p in points if point_tag(*p) not in known]
+    def rank(p):
+        cost = sum(runtime_model.predict(stage, *p) for stage in ("sterile", "class")) if runtime_model else 0.0
+        return tiers.get(tuple(p), 0), -cost
+    new_points.sort(key=rank)
+    stamp = time.strftime(STAMP_FORMAT)
+    for rank, (mass, theta) in enumerate(new_points):
+        name = f"{stamp}{rank:06d}_{point_tag(mass, theta)}.json"
+        _write_ticket(os.path.join(qdir, "pending", name),
+                      {"mass_keV": mass, "mixing_angle": theta, "attempts": 0})
+    return len(new_points)
+
+def claim(qdir=None, worker=None):
+    """Atomically claims the first pending ticket that is due. Returns (claimed_path, ticket) or None."""
+    qdir = qdir or queue_dir()
+    worker = worker or worker_id()
+    pending_dir = os.path.join(qdir, "pending")
+    now = time.strftime(STAMP_FORMAT)
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith(".json") or name[:len(now)] > now:
+            continue
+        pending_path = os.path.join(pending_dir, name)
+        claimed_path = os.path.join(qdir, "claimed", f"{os.path.splitext(name)[0]}@{worker}.json")
+        try:
+            os.utime(pending_path)  # rename keeps the mtime; a fresh one keeps the claim from looking stale
+            os.rename(pending_path, claimed_path)
+        except FileNotFoundError:
+            continue  # another worker was faster
+        with open(claimed_path) as f:
+            return claimed_path, json.load(f)
+    return None
+
+def finish(claimed_path, ok, qdir=None):
+    """Moves a claimed ticket to done/ or failed/."""
+    qdir = qdir or queue_dir()
+    name = os.path.basename(claimed_path).split("@", 1)[0] + ".json"
+    os.rename(claimed_path, os.path.join(qdir, "done" if ok else "failed", name))
+
+def defer(claimed_path, ticket, delay, qdir=None):
+    """Moves a claimed ticket (with its updated contents) back to pending, due in `delay` seconds."""
+    qdir = qdir or queue_dir()
+    due = time.strftime(STAMP_FORMAT, time.localtime(time.time() + delay))
+    name = f"{due}{0:06d}_{_ticket_tag(os.path.basename(claimed_path))}.json"
+    _write_ticket(claimed_path, ticket)
+    os.rename(claimed_path, os.path.join(qdir, "pending", name))
+
+def requeue_stale(qdir=None, stale_after=queue_stale_after, max_attempts=queue_max_attempts):
+    """
+    Moves claims without a recent heartbeat (crashed or killed workers) back to pending,
+    or to failed once a ticket has been claimed max_attempts times. Returns the number moved.
+    """
+    qdir = qdir or queue_dir()
+    claimed_dir = os.path.join(qdir, "claimed")
+    moved = 0
+    now = time.time()
+    for name in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, name)
+        try:
+            if not name.endswith(".json") or now - os.path.getmtime(path) < stale_after:
+                continue
+            # Win the ticket first, so only one worker rewrites it
+            reaping = os.path.join(qdir, f".reap-{name}")
+            os.rename(path, reaping)
+        except FileNotFoundError:
+            continue
+        with open(reaping) as f:
+            ticket = json.load(f)
+        ticket["attempts"] = ticket.get("attempts", 0) + 1
+        state = "failed" if ticket["attempts"] >= max_attempts else "pending"
+        _write_ticket(os.path.join(qdir, state, name.split("@", 1)[0] + ".json"), ticket)
+        os.remove(reaping)
+        print(f"[queue] Requeued {_ticket_tag(name)} from stale claim ({state}, attempt {ticket['attempts']}).")
+        moved += 1
+    return moved
+
+class Heartbeat:
+    """Touches a claimed ticket every `interval` seconds from a background thread."""
+    def __init__(self, path, interval=queue_heartbeat):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return  # requeued by another worker after a long stall
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def queue_finished(qdir=None):
+    """True once tickets were queued and all of them are done or failed."""
+    tags = queued_tags(qdir or queue_dir())
+    return not tags["pending"] and not tags["claimed"] and bool(tags["done"] or tags["failed"])
+
+def worker_loop(qdir=None, exit_when_empty=True):
+    """
+    Claims and runs points until the queue is drained (pending and claimed both empty).
+    A worker started before anything was queued waits for the first tickets.
+    Each point runs both stages in this process while its ticket is kept alive. A point
+    whose stage failed transiently goes back to pending until its backoff has passed.
+    """
+    from scheduler import RuntimeModel, run_stage, retry_delay, now_iso
+    from runner import point_done
+    from progress import ProgressTracker
+
+    qdir = ensure_queue(qdir or queue_dir())
+    worker = worker_id()
+    model = RuntimeModel()
+    progress = ProgressTracker()
+    print(f"[queue] Worker {worker} started.")
+    if not any(queued_tags(qdir).values()):
+        print(f"[queue] Nothing queued yet in {qdir}; waiting for tickets (python main.py --enqueue).")
+    while True:
+        requeue_stale(qdir)
+        job = claim(qdir, worker)
+        if job is None:
+            if exit_when_empty and queue_finished(qdir):
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        claimed_path, ticket = job
+        mass, theta = ticket["mass_keV"], ticket["mixing_angle"]
+        tag = point_tag(mass, theta)
+        progress.emit("point_started", tag, mass_keV=mass, mixing_angle=theta, worker=worker)
+        with Heartbeat(claimed_path):
+            ok = True
+            for stage in ("sterile", "class"):
+                started = now_iso()
+                progress.emit("stage_submitted", tag, stage=stage, worker=worker)
+                ok, seconds, ran = run_stage(stage, mass, theta)
+                if ran:
+                    model.record(stage, mass, theta, seconds)
+                progress.emit("stage_finished", tag, stage=stage, ok=ok, seconds=seconds, skipped=not ran)
+                if not ok:
+                    break
+        if not ok:
+            retries = ticket.setdefault("retries", {})
+            delay = retry_delay(stage, mass, theta, started, retries.get(stage, 0))
+            if delay is not None:
+                retries[stage] = retries.get(stage, 0) + 1
+                try:
+                    defer(claimed_path, ticket, delay, qdir)
+                except FileNotFoundError:
+                    print(f"[queue] Claim on {tag} was lost while running; not retried.")
+                continue
+        # A sterile step can end the point without error (overproduction)
+        ok = ok or point_done(os.path.join(base_output_dir, tag))
+        progress.emit("point_finished" if ok else "point_failed", tag, worker=worker)
+        try:
+            finish(claimed_path, ok, qdir)
+        except FileNotFoundError:
+            print(f"[queue] Claim on {tag} was lost while running; result kept.")
+    print(f"[queue] Worker {worker} finished: queue is empty.")
+
+def run_workers(jobs=1, qdir=None):
+    """Runs `jobs` worker processes on this node and waits for them."""
+    if jobs <= 1:
+        worker_loop(qdir)
+        return
+    from scheduler import worker_context
+    ctx = worker_context()
+    workers = [ctx.Process(target=worker_loop, args=(qdir,)) for _ in range(jobs)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()